@@ -1,43 +1,63 @@
 # Harmonic potential with respect to a fixed point in space
 
 from MMTK.ForceFields.ForceField import ForceField
+from MMTK.ChemicalObjects import isChemicalObject
+from Scientific import N
 from MMTK_harmonic_oscillator import HarmonicOscillatorTerm
 
 class HarmonicOscillatorForceField(ForceField):
 
     """Harmonic potential with respect to a fixed point in space
 
-    Constructor: HarmonicOscillatorForceField(|atom|, |center|,
-                                              |force_constant|)
+    Constructor: HarmonicOscillatorForceField(|atoms|, |centers|,
+                                              |force_constants|)
 
     Arguments:
 
-    |atom| -- an atom object, specifying the
-              atom on which the force field acts
+    |atoms| -- a list of atom objects, specifying the
+               atoms on which the force field acts. A single atom
+               is accepted as well.
 
-    |center| -- a vector defining the point to which the atom is
-                attached by the harmonic potential
+    |centers| -- a list of vectors (or an array of shape (N, 3)) defining
+                 the points to which the atoms are attached by the
+                 harmonic potential. For a single atom, a single vector.
 
-    |force_constant| -- the force constant of the harmonic potential
-                        (a real number)
+    |force_constants| -- the force constants of the harmonic potentials
+                         (a list of real numbers, or a single real
+                         number for a single atom)
     """
 
-    def __init__(self, atom, center, force_constant):
-        # Get the internal index of the atom if the argument is an
-        # atom object. It is the index that is stored internally,
+    def __init__(self, atoms, centers, force_constants):
+        if isinstance(atoms, int) or isChemicalObject(atoms):
+            atoms = [atoms]
+            centers = [centers]
+            force_constants = [force_constants]
+        # Get the internal indices of the atoms if the arguments are
+        # atom objects. It is the index that is stored internally,
         # and when the force field is recreated from a specification
         # in a trajectory file, it is the index that is passed instead
         # of the atom object itself. Calling this method takes care
         # of all the necessary checks and conversions.
-        self.atom_index = self.getAtomParameterIndices([atom])[0]
+        self.atom_indices = self.getAtomParameterIndices(atoms)
         # Store arguments that recreate the force field from a pickled
         # universe or from a trajectory.
-        self.arguments = (self.atom_index, center, force_constant)
+        centers = [tuple(c) for c in centers]
+        force_constants = list(force_constants)
+        self.arguments = (self.atom_indices, centers, force_constants)
         # Initialize the ForceField class, giving a name to this one.
         ForceField.__init__(self, 'harmonic_oscillator')
-        # Store the parameters for later use.
-        self.center = center
-        self.force_constant = force_constant
+        # Store the parameters for later use, already converted to the
+        # array form that the Pyrex code works on. This is done only
+        # once, whereas evaluatorTerms is called for every new evaluator.
+        n = len(self.atom_indices)
+        if len(centers) != n or len(force_constants) != n:
+            raise ValueError("inconsistent number of parameters")
+        self.indices = N.array(self.atom_indices, N.Int)
+        self.centers = N.array(centers, N.Float)
+        self.force_constants = N.array(force_constants, N.Float)
+        self.indices.shape = (n,)
+        self.centers.shape = (n, 3)
+        self.force_constants.shape = (n,)
 
     # The following method is called by the energy evaluation engine
     # to inquire if this force field term has all the parameters it
@@ -58,6 +78,6 @@ class HarmonicOscillatorForceField(ForceField):
         # Here we pass all the parameters to the Pyrex code
         # that handles energy calculations.
         return [HarmonicOscillatorTerm(universe,
-                                       self.atom_index,
-                                       self.center,
-                                       self.force_constant)]
+                                       self.indices,
+                                       self.centers,
+                                       self.force_constants)]
@@ -25,21 +25,21 @@ include 'MMTK/forcefield.pxi'
 #
 cdef class HarmonicOscillatorTerm(EnergyTerm):
 
-    cdef int atom_index
-    cdef double ref_x, ref_y, ref_z
-    cdef double k
+    cdef ArrayType atom_indices, references, force_constants
+    cdef int n
 
-    def __init__(self, universe, atom_index, reference, force_constant):
-        cdef ArrayType ref_array
+    # atom_indices must be a contiguous array of type N.Int,
+    # references and force_constants contiguous arrays of type N.Float
+    # with shapes (n, 3) and (n,). All oscillators are handled by one
+    # term, which is much faster than one term per oscillator.
+    def __init__(self, universe, atom_indices, references, force_constants):
         EnergyTerm.__init__(self, universe,
                             "harmonic_oscillator", ("harmonic_oscillator",))
         self.eval_func = <void *>HarmonicOscillatorTerm.evaluate
-        self.atom_index = atom_index
-        ref_array = reference.array
-        self.ref_x = (<double *>ref_array.data)[0]
-        self.ref_y = (<double *>ref_array.data)[1]
-        self.ref_z = (<double *>ref_array.data)[2]
-        self.k = force_constant
+        self.atom_indices = atom_indices
+        self.references = references
+        self.force_constants = force_constants
+        self.n = atom_indices.dimensions[0]
 
     # The function evaluate is called for every single energy
     # evaluation and should therefore be optimized for speed.
@@ -52,28 +52,46 @@ cdef class HarmonicOscillatorTerm(EnergyTerm):
     # For details, see MMTK_forcefield.pxi.
     cdef void evaluate(self, EnergyEvaluator eval,
                        energy_spec *input, energy_data *energy):
-        cdef vector3 *coordinates, *gradients
-        cdef double *fc
-        cdef double dx, dy, dz
-        cdef int n, offset
+        cdef vector3 *coordinates, *gradients, *ref
+        cdef long *indices
+        cdef double *k, *fc
+        cdef double dx, dy, dz, e
+        cdef int i, j, n, offset
         coordinates = <vector3 *>input.coordinates.data
-        dx = coordinates[self.atom_index][0] - self.ref_x
-        dy = coordinates[self.atom_index][1] - self.ref_y
-        dz = coordinates[self.atom_index][2] - self.ref_z
-        energy.energy_terms[self.index] = 0.5*self.k*(dx*dx + dy*dy + dz*dz)
-        energy.virial_available = 0 # we don't do virials here
+        indices = <long *>self.atom_indices.data
+        ref = <vector3 *>self.references.data
+        k = <double *>self.force_constants.data
+        gradients = NULL
         if energy.gradients != NULL:
             gradients = <vector3 *>(<PyArrayObject *> energy.gradients).data
-            gradients[self.atom_index][0] = \
-                         gradients[self.atom_index][0] + self.k*dx
-            gradients[self.atom_index][1] = \
-                         gradients[self.atom_index][1] + self.k*dy
-            gradients[self.atom_index][2] = \
-                         gradients[self.atom_index][2] + self.k*dz
+        fc = NULL
         if energy.force_constants != NULL:
             fc = <double *>(<PyArrayObject *> energy.force_constants).data
             n = (<PyArrayObject *> energy.force_constants).dimensions[0]
-            offset = (9*n+3)*self.atom_index
-            fc[offset + 3*n*0 + 0] = fc[offset + 3*n*0 + 0] + self.k
-            fc[offset + 3*n*1 + 1] = fc[offset + 3*n*1 + 1] + self.k
-            fc[offset + 3*n*2 + 2] = fc[offset + 3*n*2 + 2] + self.k
+        # The energy, gradient and force constant contributions are
+        # computed in separate loops without branches in their bodies,
+        # which allows the C compiler to vectorize them.
+        e = 0.
+        for i from 0 <= i < self.n:
+            j = indices[i]
+            dx = coordinates[j][0] - ref[i][0]
+            dy = coordinates[j][1] - ref[i][1]
+            dz = coordinates[j][2] - ref[i][2]
+            e = e + 0.5*k[i]*(dx*dx + dy*dy + dz*dz)
+        if gradients != NULL:
+            for i from 0 <= i < self.n:
+                j = indices[i]
+                gradients[j][0] = gradients[j][0] \
+                                  + k[i]*(coordinates[j][0] - ref[i][0])
+                gradients[j][1] = gradients[j][1] \
+                                  + k[i]*(coordinates[j][1] - ref[i][1])
+                gradients[j][2] = gradients[j][2] \
+                                  + k[i]*(coordinates[j][2] - ref[i][2])
+        if fc != NULL:
+            for i from 0 <= i < self.n:
+                offset = (9*n+3)*indices[i]
+                fc[offset + 3*n*0 + 0] = fc[offset + 3*n*0 + 0] + k[i]
+                fc[offset + 3*n*1 + 1] = fc[offset + 3*n*1 + 1] + k[i]
+                fc[offset + 3*n*2 + 2] = fc[offset + 3*n*2 + 2] + k[i]
+        energy.energy_terms[self.index] = e
+        energy.virial_available = 0 # we don't do virials here
@@ -227,6 +227,7 @@ class BondList(list):
     def _clearCache(self):
         self.bond_angles = None
         self.dihedral_angles = None
+        self.bond_graph = None
 
     def __getinitargs__(self):
         return (None,)
@@ -315,6 +316,34 @@ class BondList(list):
         """
         return [b.otherAtom(atom) for b in self if b.hasAtom(atom)]
 
+    def bondGraph(self):
+        """
+        @returns: the bond graph in integer form, as a tuple
+                  (atoms, numbers, neighbours). atoms is the list of
+                  all atoms in the bond list, numbers a dictionary mapping
+                  each atom to its position in that list, and
+                  neighbours[i] the list of the positions of the atoms
+                  bonded to atoms[i]. The graph is cached until the bond
+                  list is modified and must not be changed by the caller.
+        @rtype: C{tuple}
+        """
+        if getattr(self, 'bond_graph', None) is None:
+            atoms = []
+            numbers = {}
+            neighbours = []
+            for bond in self:
+                for a in (bond.a1, bond.a2):
+                    if a not in numbers:
+                        numbers[a] = len(atoms)
+                        atoms.append(a)
+                        neighbours.append([])
+                i1 = numbers[bond.a1]
+                i2 = numbers[bond.a2]
+                neighbours[i1].append(i2)
+                neighbours[i2].append(i1)
+            self.bond_graph = (atoms, numbers, neighbours)
+        return self.bond_graph
+
     def bondsOf(self, atom):
         """
         @param atom: an atom
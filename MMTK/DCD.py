@@ -86,10 +86,10 @@ def writeDCD(vector_list, dcd_file_name, factor, atom_order=None,
     for vector in vector_list:
         if conf_flag:
             vector = universe.contiguousObjectConfiguration(None, vector)
-        array = factor*vector.array
-        x = N.take(array[:, 0], atom_order).astype(N.Float16)
-        y = N.take(array[:, 1], atom_order).astype(N.Float16)
-        z = N.take(array[:, 2], atom_order).astype(N.Float16)
+        array = factor*N.take(vector.array, atom_order)
+        x = array[:, 0].astype(N.Float16)
+        y = array[:, 1].astype(N.Float16)
+        z = array[:, 2].astype(N.Float16)
         MMTK_DCD.writeDCDStep(fd, x, y, z)
     MMTK_DCD.writeCloseDCD(fd)
 
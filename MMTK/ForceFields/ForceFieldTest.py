@@ -10,15 +10,17 @@ Force field consistency tests
 
 __docformat__ = 'epytext'
 
-from MMTK import Utility
-from Scientific.Geometry import Vector, ex, ey, ez
+from Scientific.Geometry import Vector
 from Scientific import N
-import itertools
 
 #
 # Check consistency of energies and gradients.
 #
-def gradientTest(universe, atoms = None, delta = 0.0001):
+# Vertices of a regular tetrahedron centered at the origin, as unit vectors.
+_tetrahedron = N.array([[1., 1., 1.], [1., -1., -1.],
+                        [-1., 1., -1.], [-1., -1., 1.]])/N.sqrt(3.)
+
+def gradientTest(universe, atoms = None, delta = 0.0001, tetrahedral = False):
     """
     Test gradients by comparing to numerical derivatives of the energy.
     @param universe: the universe on which the test is performed
@@ -28,23 +30,44 @@ def gradientTest(universe, atoms = None, delta = 0.0001):
     @type atoms: C{list}
     @param delta: the step size used in calculating the numerical derivatives
     @type delta: C{float}
+    @param tetrahedral: if C{True}, the numerical derivatives are obtained
+                        from four energy evaluations per atom, displacing
+                        the atom towards the vertices of a regular
+                        tetrahedron, instead of the six evaluations of
+                        central differences along the three axes. This
+                        is faster but only first-order accurate in delta.
+    @type tetrahedral: C{bool}
     """
     e0, grad = universe.energyAndGradients()
     print 'Energy: ', e0
     if atoms is None:
         atoms = universe.atomList()
+    # Displace atoms by writing directly into the configuration array,
+    # avoiding the Vector allocation and method dispatch of setPosition().
+    conf = universe.configuration().array
     for a in atoms:
         print a
         print grad[a]
-        num_grad = []
-        for v in [ex, ey, ez]:
-            x = a.position()
-            a.setPosition(x+delta*v)
-            eplus = universe.energy()
-            a.setPosition(x-delta*v)
-            eminus = universe.energy()
-            a.setPosition(x)
-            num_grad.append(0.5*(eplus-eminus)/delta)
+        i = a.index
+        ref = conf[i].copy()
+        if tetrahedral:
+            # The vertex vectors u sum to zero and sum(u u) = 4/3 I,
+            # so the gradient is 3/(4 delta) sum(e(x+delta u) u).
+            energies = N.zeros((4,), N.Float)
+            for k in range(4):
+                conf[i] = ref + delta*_tetrahedron[k]
+                energies[k] = universe.energy()
+            conf[i] = ref
+            num_grad = 0.75*N.dot(energies, _tetrahedron)/delta
+        else:
+            num_grad = N.zeros((3,), N.Float)
+            for k in range(3):
+                conf[i, k] = ref[k] + delta
+                eplus = universe.energy()
+                conf[i, k] = ref[k] - delta
+                eminus = universe.energy()
+                conf[i, k] = ref[k]
+                num_grad[k] = 0.5*(eplus-eminus)/delta
         print Vector(num_grad)
 
 #
@@ -65,21 +88,28 @@ def forceConstantTest(universe, atoms = None, delta = 0.0001):
     e0, grad0, fc = universe.energyGradientsAndForceConstants()
     if atoms is None:
         atoms = universe.atomList()
-    for a1, a2 in itertools.chain(itertools.izip(atoms, atoms),
-                                  Utility.pairs(atoms)):
-        print a1, a2
-        print fc[a1, a2]
-        num_fc = []
-        for v in [ex, ey, ez]:
-            x = a1.position()
-            a1.setPosition(x+delta*v)
-            e_plus, grad_plus = universe.energyAndGradients()
-            a1.setPosition(x-delta*v)
-            e_minus, grad_minus = universe.energyAndGradients()
-            a1.setPosition(x)
-            num_fc.append(0.5*(grad_plus[a2]-grad_minus[a2])/delta)
-        print N.array(map(lambda a: a.array, num_fc))
-
+    # The gradients obtained by displacing a1 serve for all partners a2,
+    # so only six evaluations per atom are needed.
+    conf = universe.configuration().array
+    for i, a1 in enumerate(atoms):
+        grad_plus = []
+        grad_minus = []
+        j = a1.index
+        ref = conf[j].copy()
+        for k in range(3):
+            conf[j, k] = ref[k] + delta
+            grad_plus.append(universe.energyAndGradients()[1].array)
+            conf[j, k] = ref[k] - delta
+            grad_minus.append(universe.energyAndGradients()[1].array)
+            conf[j, k] = ref[k]
+        for a2 in atoms[i:]:
+            print a1, a2
+            print fc[a1, a2]
+            num_fc = N.zeros((3, 3), N.Float)
+            for k in range(3):
+                num_fc[k] = 0.5*(grad_plus[k][a2.index]
+                                 - grad_minus[k][a2.index])/delta
+            print num_fc
 
 
 if __name__ == '__main__':
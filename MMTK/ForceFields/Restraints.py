@@ -29,6 +29,14 @@ from MMTK_forcefield import HarmonicDistanceTerm, HarmonicAngleTerm, \
                             CosineDihedralTerm
 from Scientific import N
 
+def _checkSubsets(pairs, subset1, subset2):
+    s1 = frozenset([a.index for a in subset1.atomList()])
+    s2 = frozenset([a.index for a in subset2.atomList()])
+    for i1, i2 in pairs:
+        if not ((i1 in s1 and i2 in s2) or (i1 in s2 and i2 in s1)):
+            raise ValueError("restraint outside subset")
+
+
 class HarmonicDistanceRestraint(ForceField):
 
     """
@@ -53,27 +61,82 @@ class HarmonicDistanceRestraint(ForceField):
         self.arguments = (self.index1, self.index2, distance, force_constant) 
         self.distance = distance
         self.force_constant = force_constant
+        self._params_tuple = (self.index1, self.index2,
+                              distance, force_constant)
+        self._indices = N.array([(self.index1, self.index2)], N.Int)
+        self._parameters = N.array([(distance, force_constant)], N.Float)
         ForceField.__init__(self, 'harmonic distance restraint')
 
     def evaluatorParameters(self, universe, subset1, subset2, global_data):
         if subset1 is not None:
-            s1 = subset1.atomList()
-            s2 = subset2.atomList()
-            if not ((self.atom1 in s1 and self.atom2 in s2) or \
-                    (self.atom1 in s2 and self.atom2 in s1)):
-                raise ValueError("restraint outside subset")
+            _checkSubsets([(self.index1, self.index2)], subset1, subset2)
+        return {'harmonic_distance_term': [self._params_tuple]}
+
+    def evaluatorTerms(self, universe, subset1, subset2, global_data):
+        if subset1 is not None:
+            _checkSubsets([(self.index1, self.index2)], subset1, subset2)
+        return [HarmonicDistanceTerm(universe._spec, self._indices,
+                                     self._parameters, self.name)]
+
+    def description(self):
+        return 'ForceFields.Restraints.' + self.__class__.__name__ + \
+               `self.arguments`
+
+
+class HarmonicDistanceRestraintList(ForceField):
+
+    """
+    Harmonic distance restraints between many pairs of atoms
+
+    The result is equivalent to the sum of one L{HarmonicDistanceRestraint}
+    per pair, but all restraints are evaluated by a single energy term,
+    which is much more efficient for large numbers of restraints.
+    """
+
+    def __init__(self, pairs, distances, force_constants):
+        """
+        @param pairs: the restrained atom pairs
+        @type pairs: sequence of C{tuple}s of two
+                     L{MMTK.ChemicalObjects.Atom}s
+        @param distances: the distances at which the restraints are zero
+        @type distances: sequence of C{float}
+        @param force_constants: the force constants of the restraint terms
+                                (see L{HarmonicDistanceRestraint})
+        @type force_constants: sequence of C{float}
+        """
+        indices = [self.getAtomParameterIndices(pair) for pair in pairs]
+        distances = list(distances)
+        force_constants = list(force_constants)
+        if len(distances) != len(indices) \
+               or len(force_constants) != len(indices):
+            raise ValueError("inconsistent number of restraint parameters")
+        self.arguments = (indices, distances, force_constants)
+        # The energy term reads the rows in order. Sorting them by
+        # atom index makes its accesses to the coordinate and gradient
+        # arrays nearly sequential, which is much more cache-friendly
+        # for large restraint sets than the arbitrary input order.
+        rows = [(min(i), max(i), d, k)
+                for i, d, k in zip(indices, distances, force_constants)]
+        rows.sort()
+        self._indices = N.array([r[:2] for r in rows], N.Int)
+        self._parameters = N.array([r[2:] for r in rows], N.Float)
+        self._indices.shape = (len(rows), 2)
+        self._parameters.shape = (len(rows), 2)
+        ForceField.__init__(self, 'harmonic distance restraint')
+
+    def evaluatorParameters(self, universe, subset1, subset2, global_data):
+        if subset1 is not None:
+            _checkSubsets(self.arguments[0], subset1, subset2)
         return {'harmonic_distance_term':
-                [(self.index1, self.index2,
-                  self.distance, self.force_constant)]}
+                [tuple(i) + tuple(p)
+                 for i, p in zip(self.arguments[0],
+                                 zip(*self.arguments[1:]))]}
 
     def evaluatorTerms(self, universe, subset1, subset2, global_data):
-        params = self.evaluatorParameters(universe, subset1, subset2,
-                                          global_data)['harmonic_distance_term']
-        assert len(params) == 1
-        indices = N.array([params[0][:2]])
-        parameters = N.array([params[0][2:]])
-        return [HarmonicDistanceTerm(universe._spec, indices, parameters,
-                                     self.name)]
+        if subset1 is not None:
+            _checkSubsets(self.arguments[0], subset1, subset2)
+        return [HarmonicDistanceTerm(universe._spec, self._indices,
+                                     self._parameters, self.name)]
 
     def description(self):
         return 'ForceFields.Restraints.' + self.__class__.__name__ + \
@@ -107,21 +170,19 @@ class HarmonicAngleRestraint(ForceField):
                           angle, force_constant) 
         self.angle = angle
         self.force_constant = force_constant
+        self._params_tuple = (self.index1, self.index2, self.index3,
+                              angle, force_constant)
+        self._indices = N.array([(self.index1, self.index2, self.index3)],
+                                N.Int)
+        self._parameters = N.array([(angle, force_constant)], N.Float)
         ForceField.__init__(self, 'harmonic angle restraint')
 
     def evaluatorParameters(self, universe, subset1, subset2, global_data):
-        return {'harmonic_angle_term':
-                 [(self.index1, self.index2, self.index3,
-                   self.angle, self.force_constant)]}
+        return {'harmonic_angle_term': [self._params_tuple]}
 
     def evaluatorTerms(self, universe, subset1, subset2, global_data):
-        params = self.evaluatorParameters(universe, subset1, subset2,
-                                          global_data)['harmonic_angle_term']
-        assert len(params) == 1
-        indices = N.array([params[0][:3]])
-        parameters = N.array([params[0][3:]])
-        return [HarmonicAngleTerm(universe._spec, indices, parameters,
-                                  self.name)]
+        return [HarmonicAngleTerm(universe._spec, self._indices,
+                                  self._parameters, self.name)]
 
 class HarmonicDihedralRestraint(ForceField):
 
@@ -153,19 +214,18 @@ class HarmonicDihedralRestraint(ForceField):
         self.force_constant = force_constant
         self.arguments = (self.index1, self.index2, self.index3, self.index4,
                           dihedral, force_constant) 
+        self._params_tuple = (self.index1, self.index2,
+                              self.index3, self.index4,
+                              0., dihedral, 0., force_constant)
+        self._indices = N.array([(self.index1, self.index2,
+                                  self.index3, self.index4)], N.Int)
+        self._parameters = N.array([(0., dihedral, 0., force_constant)],
+                                   N.Float)
         ForceField.__init__(self, 'harmonic dihedral restraint')
 
     def evaluatorParameters(self, universe, subset1, subset2, global_data):
-        return {'cosine_dihedral_term': [(self.index1, self.index2,
-                                          self.index3, self.index4,
-                                          0., self.dihedral,
-                                          0., self.force_constant)]}
+        return {'cosine_dihedral_term': [self._params_tuple]}
 
     def evaluatorTerms(self, universe, subset1, subset2, global_data):
-        params = self.evaluatorParameters(universe, subset1, subset2,
-                                          global_data)['cosine_dihedral_term']
-        assert len(params) == 1
-        indices = N.array([params[0][:4]])
-        parameters = N.array([params[0][4:]])
-        return [CosineDihedralTerm(universe._spec, indices, parameters,
-                                   self.name)]
+        return [CosineDihedralTerm(universe._spec, self._indices,
+                                   self._parameters, self.name)]
@@ -11,8 +11,18 @@ Manipulation of molecular configurations in terms of internal coordinates
 __docformat__ = 'epytext'
 
 import MMTK
+from Scientific.Geometry import Vector
 from Scientific import N
 
+#
+# Cross product of two 3-element arrays, avoiding the creation of
+# Vector objects in the setValue methods.
+#
+def _cross(a, b):
+    return N.array([a[1]*b[2]-a[2]*b[1],
+                    a[2]*b[0]-a[0]*b[2],
+                    a[0]*b[1]-a[1]*b[0]])
+
 #
 # The abstract base class
 #
@@ -31,12 +41,48 @@ class InternalCoordinate:
             if a not in self.molecule.atomList():
                 raise ValueError("atoms not in the same molecule")
         self.universe = self.molecule.universe()
-        if self.universe is None:
+        self._in_universe = self.universe is not None
+        if not self._in_universe:
             self.universe = MMTK.InfiniteUniverse()
+        self._indices = self._idx1 = self._idx2 = None
+        self._index_version = None
+
+    def _updateIndices(self):
+        # Indices of the atoms and fragments in the configuration array.
+        # They are assigned by Universe.configuration() and change
+        # when objects are added to or removed from the universe,
+        # so they are recomputed whenever the universe version changes.
+        # Atoms outside a universe have no index.
+        if not self._in_universe \
+               or self._index_version == self.universe._version:
+            return
+        self.universe.configuration()
+        self._indices = [a.index for a in self.atoms]
+        self._idx1 = N.array([a.index for a in self._atoms1])
+        self._idx2 = N.array([a.index for a in self._atoms2])
+        self._index_version = self.universe._version
+
+    def _position(self, i):
+        # Position of self.atoms[i], read directly from the
+        # configuration array when the atoms are part of a universe.
+        if self._indices is None:
+            return self.atoms[i].position()
+        return Vector(self.universe.configuration().array[self._indices[i]])
+
+    def bondGraph(self):
+        bonds = getattr(self.molecule, 'bonds', None)
+        if bonds is None:
+            return [], {}, []
+        return bonds.bondGraph()
 
-    def bondTest(self):
+    def bondTest(self, graph = None):
+        if graph is None:
+            graph = self.bondGraph()
+        atoms, numbers, neighbours = graph
         for i in range(len(self.atoms)-1):
-            if not self.atoms[i] in self.atoms[i+1].bondedTo():
+            n1 = numbers.get(self.atoms[i])
+            n2 = numbers.get(self.atoms[i+1])
+            if n1 is None or n2 is None or n1 not in neighbours[n2]:
                 raise ValueError("no bond between %s and %s"
                                   % (self.atoms[i], self.atoms[i+1]))
 
@@ -45,30 +91,78 @@ class InternalCoordinate:
         self.fragment2 = MMTK.Collection()
         spec1 = (self.fragment1,) + spec1
         spec2 = (self.fragment2,) + spec2
-        self.molecule.setBondAttributes()
-        try:
-            self.bondTest()
-            for fragment, start, excluded, error_check in [spec1, spec2]:
-                atoms = set([start])
+        # The bond graph is cached by the molecule's bond list, so
+        # creating many coordinates on one molecule analyzes it only once.
+        # The search works on atom numbers with a flat visited list.
+        graph = self.bondGraph()
+        self.bondTest(graph)
+        atoms, numbers, neighbours = graph
+        for fragment, start, excluded, error_check in [spec1, spec2]:
+            start = numbers[start]
+            excluded = numbers[excluded]
+            visited = len(atoms)*[False]
+            visited[start] = True
+            found = [start]
+            new_atoms = []
+            for i in neighbours[start]:
+                if i != excluded and not visited[i]:
+                    visited[i] = True
+                    new_atoms.append(i)
+            while new_atoms:
+                found.extend(new_atoms)
+                check = new_atoms
                 new_atoms = []
-                for a in start.bondedTo():
-                    if a is not excluded and a is not start:
-                        atoms.add(a)
-                        new_atoms.append(a)
-                while new_atoms:
-                    check = new_atoms
-                    new_atoms = []
-                    for a in check:
-                        for na in a.bondedTo():
-                            if na not in atoms:
-                                atoms.add(na)
-                                new_atoms.append(na)
-                if error_check in atoms:
-                    raise ValueError("cyclic bond structure")
-                for a in atoms:
-                    fragment.addObject(a)
-        finally:
-            self.molecule.clearBondAttributes()
+                for i in check:
+                    for j in neighbours[i]:
+                        if not visited[j]:
+                            visited[j] = True
+                            new_atoms.append(j)
+            if visited[numbers[error_check]]:
+                raise ValueError("cyclic bond structure")
+            fragment.addObject([atoms[i] for i in found])
+        # The fragments never change, so their masses and atom lists
+        # are computed once here rather than in every call to setValue.
+        self._m1 = self.fragment1.mass()
+        self._m2 = self.fragment2.mass()
+        self._atoms1 = self.fragment1.atomList()
+        self._atoms2 = self.fragment2.atomList()
+        self._masses1 = N.array([a._mass for a in self._atoms1])
+        self._masses2 = N.array([a._mass for a in self._atoms2])
+
+    def _axisMomentOfInertia(self, fragment, indices, masses, m,
+                             pivot, axis):
+        # Moment of inertia of a fragment with respect to the rotation
+        # axis through pivot, using axis.(r^2 I - r r).axis = r^2-(r.axis)^2
+        # for a unit vector axis, so that no 3x3 tensor is needed.
+        if indices is None:
+            cm, t = fragment.centerAndMomentOfInertia()
+            d = self.universe.distanceVector(pivot, cm)
+            return axis*(t*axis) + m*(d*d-(d*axis)**2)
+        pos = N.take(self.universe.configuration().array, indices, axis=0)
+        offset = self.universe.contiguousObjectOffset([fragment])
+        if offset is not None:
+            pos = pos + N.take(offset.array, indices, axis=0)
+        cm = N.add.reduce(masses[:, N.NewAxis]*pos)/m
+        # Positions relative to the pivot, built from the minimum-image
+        # vector pivot->cm so that periodic universes are handled too.
+        d = self.universe.distanceVector(pivot, Vector(cm)).array
+        r = pos - cm + d
+        r_axis = N.dot(r, axis.array)
+        return N.add.reduce(masses*(N.add.reduce(r*r, 1) - r_axis*r_axis))
+
+    def _rotateFragment(self, fragment, indices, point, axis, angle):
+        # Equivalent to fragment.rotateAroundAxis(point, point+axis, angle),
+        # but rotating all atoms with a single matrix product on the
+        # configuration array instead of one Transformation call per atom.
+        if indices is None:
+            fragment.rotateAroundAxis(point, point+axis, angle)
+            return
+        from Scientific.Geometry.Transformation import Rotation
+        rotation = Rotation(axis, angle).tensor.array
+        conf = self.universe.configuration().array
+        p = point.array
+        conf[indices] = N.dot(N.take(conf, indices, axis=0)-p,
+                              N.transpose(rotation)) + p
 
 #
 # Bond length
@@ -120,15 +214,13 @@ class BondLength(InternalCoordinate):
         @param value: the desired length of the bond
         @type value: C{float}
         """
-        v = self.universe.distanceVector(self.atoms[0], self.atoms[1])
-        axis = v.normal()
-        distance = value - v.length()
-        m1 = self.fragment1.mass()
-        m2 = self.fragment2.mass()
-        d1 = -m2*distance/(m1+m2)
-        d2 = m1*distance/(m1+m2)
-        self.fragment1.translateBy(d1*axis)
-        self.fragment2.translateBy(d2*axis)
+        # distanceVector applies the minimum-image convention; the rest
+        # is done on the raw array to avoid creating Vector temporaries.
+        v = self.universe.distanceVector(self.atoms[0], self.atoms[1]).array
+        length = N.sqrt(N.dot(v, v))
+        shift = (value - length)*v/(length*(self._m1+self._m2))
+        self.fragment1.translateBy(Vector(-self._m2*shift))
+        self.fragment2.translateBy(Vector(self._m1*shift))
 
 #
 # Bond angles
@@ -185,30 +277,30 @@ class BondAngle(InternalCoordinate):
         @param value: the desired angle
         @type value: C{float}
         """
-        from Scientific.Geometry import delta
-        v1 = self.universe.distanceVector(self.atoms[1], self.atoms[0])
-        v2 = self.universe.distanceVector(self.atoms[1], self.atoms[2])
-        angle = v1.angle(v2)
+        v1 = self.universe.distanceVector(self.atoms[1], self.atoms[0]).array
+        v2 = self.universe.distanceVector(self.atoms[1], self.atoms[2]).array
+        normal = _cross(v1, v2)
+        sin = N.sqrt(N.dot(normal, normal))
+        angle = N.arctan2(sin, N.dot(v1, v2))
         if N.fabs(angle - N.pi) < 1.e-4:
             raise ValueError("angle too close to pi")
-        axis = v1.cross(v2).normal()
+        if sin < 1.e-4*N.sqrt(N.dot(v1, v1)*N.dot(v2, v2)):
+            raise ValueError("angle too close to zero")
+        self._updateIndices()
+        axis = Vector(normal/sin)
         d = angle-value
-        cm1, th1 = self.fragment1.centerAndMomentOfInertia()
-        r1 = self.universe.distanceVector(self.atoms[1], cm1)
-        th1 -= self.fragment1.mass()*((r1*r1)*delta-r1.dyadicProduct(r1))
-        i1 = axis*(th1*axis)
-        cm2, th2 = self.fragment2.centerAndMomentOfInertia()
-        r2 = self.universe.distanceVector(self.atoms[1], cm2)
-        th2 -= self.fragment2.mass()*((r2*r2)*delta-r2.dyadicProduct(r2))
-        i2 = axis*(th2*axis)
+        i1 = self._axisMomentOfInertia(self.fragment1, self._idx1,
+                                       self._masses1, self._m1,
+                                       self.atoms[1], axis)
+        i2 = self._axisMomentOfInertia(self.fragment2, self._idx2,
+                                       self._masses2, self._m2,
+                                       self.atoms[1], axis)
         d1 = i2*d/(i1+i2)
         d2 = d1-d
-        self.fragment1.rotateAroundAxis(self.atoms[1].position(),
-                                        self.atoms[1].position()+axis,
-                                        d1)
-        self.fragment2.rotateAroundAxis(self.atoms[1].position(),
-                                        self.atoms[1].position()+axis,
-                                        d2)
+        # The central atom is on the rotation axis and doesn't move.
+        center = self._position(1)
+        self._rotateFragment(self.fragment1, self._idx1, center, axis, d1)
+        self._rotateFragment(self.fragment2, self._idx2, center, axis, d2)
 
 #
 # Dihedral angles
@@ -267,26 +359,29 @@ class DihedralAngle(InternalCoordinate):
         @param value: the desired dihedral angle
         @type value: C{float}
         """
-        from Scientific.Geometry import delta
-        angle  = self.universe.dihedral(self.atoms[0], self.atoms[1],
-                                        self.atoms[2], self.atoms[3])
+        from Scientific.Geometry.Transformation import angleFromSineAndCosine
+        # Same as self.universe.dihedral(), but reusing the central
+        # bond vector that is needed below as the rotation axis.
         v = self.universe.distanceVector(self.atoms[1], self.atoms[2])
         axis = v.normal()
+        v1 = self.universe.distanceVector(self.atoms[1], self.atoms[0])
+        v3 = self.universe.distanceVector(self.atoms[2], self.atoms[3])
+        a = v1.cross(v).normal()
+        b = v3.cross(v).normal()
+        angle = angleFromSineAndCosine(a.cross(b)*axis, a*b)
         d = N.fmod(angle-value, 2.*N.pi)
-        cm1, th1 = self.fragment1.centerAndMomentOfInertia()
-        r1 = self.universe.distanceVector(self.atoms[1], cm1)
-        th1 -= self.fragment1.mass()*((r1*r1)*delta-r1.dyadicProduct(r1))
-        i1 = axis*(th1*axis)
-        cm2, th2 = self.fragment2.centerAndMomentOfInertia()
-        r2 = self.universe.distanceVector(self.atoms[2], cm2)
-        th2 -= self.fragment2.mass()*((r2*r2)*delta-r2.dyadicProduct(r2))
-        i2 = axis*(th2*axis)
+        self._updateIndices()
+        i1 = self._axisMomentOfInertia(self.fragment1, self._idx1,
+                                       self._masses1, self._m1,
+                                       self.atoms[1], axis)
+        i2 = self._axisMomentOfInertia(self.fragment2, self._idx2,
+                                       self._masses2, self._m2,
+                                       self.atoms[2], axis)
         d1 = i2*d/(i1+i2)
         d2 = d1-d
-        self.fragment1.rotateAroundAxis(self.atoms[1].position(),
-                                        self.atoms[1].position()+axis,
-                                        d1)
-        self.fragment2.rotateAroundAxis(self.atoms[2].position(),
-                                        self.atoms[2].position()+axis,
-                                        d2)
+        # Both central atoms are on the rotation axis and don't move.
+        p1 = self._position(1)
+        p2 = self._position(2)
+        self._rotateFragment(self.fragment1, self._idx1, p1, axis, d1)
+        self._rotateFragment(self.fragment2, self._idx2, p2, axis, d2)
 
@@ -11,12 +11,16 @@ Energy minimizers
 __docformat__ = 'epytext'
 
 from MMTK import Features, ThreadManager, Trajectory, Units
-from MMTK_minimization import conjugateGradient, steepestDescent
+from Scientific import N
+try:
+    from MMTK_minimization import conjugateGradient, lbfgs, steepestDescent
+except ImportError:
+    pass
 
 try:
     import threading
     if not hasattr(threading, 'Thread'):
-	threading = None
+        threading = None
 except ImportError:
     threading = None
 
@@ -27,31 +31,45 @@ if threading:
 
     class MinimizerThread(threading.Thread):
 
-        def __init__(self, universe, target, args):
+        def __init__(self, universe, target, args, detached=False):
             threading.Thread.__init__(self, group = None,
-                                      name = 'Energy minimization',
-                                      target = target,
-                                      args = args)
+                                      name = 'Energy minimization')
             self.universe = universe
-            self.function = (target, args)
+            self._target = target
+            self._args = args
+            if detached:
+                self.setDaemon(True)
             self.start()
-            ThreadManager.registerThread(self)
+            if not detached:
+                ThreadManager.registerThread(self)
 
         def run(self):
             self.universe.acquireConfigurationChangeLock()
-            apply(apply, self.function)
-            self.universe.releaseConfigurationChangeLock()
+            try:
+                self._target(*self._args)
+            finally:
+                self.universe.releaseConfigurationChangeLock()
 
 #
 # Minimizer base class
 #
 class Minimizer(Trajectory.TrajectoryGenerator):
 
+    """
+    Base class for energy minimizers
+
+    The minimization loops run in C without holding the global
+    interpreter lock, so energy evaluation can use several threads
+    and other Python threads keep running. The lock is acquired
+    only for trajectory output and for executing the actions, which
+    therefore run like any other Python code.
+    """
+
     def __init__(self, universe, options):
-	Trajectory.TrajectoryGenerator.__init__(self, universe, options)
+        Trajectory.TrajectoryGenerator.__init__(self, universe, options)
 
     default_options = {'steps': 100, 'step_size': 0.02*Units.Ang,
-		       'convergence': 0.01*Units.kJ/(Units.mol*Units.nm),
+                       'convergence': 0.01*Units.kJ/(Units.mol*Units.nm),
                        'background': 0, 'threads': None,
                        'mpi_communicator': None, 'actions': []}
 
@@ -60,7 +78,53 @@ class Minimizer(Trajectory.TrajectoryGenerator):
     restart_data = ['configuration', 'energy']
 
     def __call__(self, options):
-	raise AttributeError
+        raise AttributeError
+
+    def _currentOptions(self):
+        # All options in one dictionary, with the same precedence
+        # as getOption.
+        options = self.default_options.copy()
+        options.update(self.options)
+        options.update(self.call_options)
+        return options
+
+    def _fixedAtoms(self, features, configuration):
+        # checkFeatures has already scanned the 'fixed' attributes,
+        # so the scan is repeated only if some atom is fixed.
+        if Features.FixedParticleFeature in features:
+            return self.universe.getAtomBooleanArray('fixed').array
+        return N.zeros((len(configuration.array),), N.Int)
+
+    def minimizeBatch(self, configurations, **options):
+        """
+        Minimize several configurations of the universe one after the
+        other, setting up the energy evaluator only once. The
+        configuration of the universe is not changed, and no actions
+        are executed. The keyword options are the same as for calling
+        the minimizer, except for background and actions.
+
+        @param configurations: the starting configurations
+        @type configurations: C{Numeric.array} of shape (B, N, 3),
+                              where N is the number of atoms
+        @returns: the minimized configurations
+        @rtype: C{Numeric.array} of shape (B, N, 3)
+        """
+        self.setCallOptions(options)
+        features = Features.checkFeatures(self, self.universe)
+        options = self._currentOptions()
+        fixed = self._fixedAtoms(features, self.universe.configuration())
+        evaluator = self.universe.energyEvaluator(
+            threads=options['threads'],
+            mpi_communicator=options['mpi_communicator'])
+        evaluator = evaluator.CEvaluator()
+        configurations = N.array(configurations, N.Float)
+        if configurations.shape[1:] != (len(fixed), 3):
+            raise ValueError("configurations don't match the universe")
+        for conf in configurations:
+            function, args = self._kernel(options, conf, fixed,
+                                          evaluator, [], '')
+            function(*args)
+        return configurations
 
 #
 # Steepest descent minimizer
@@ -108,15 +172,18 @@ class SteepestDescentMinimizer(Minimizer):
                           (default set by MMTK_ENERGY_THREADS)
         @type threads: C{int}
         @keyword background: if True, the integration is executed as a
-                             separate thread (default: False)
-        @type background: C{bool}
+                             separate thread (default: False). With
+                             'detached', the thread is a daemon thread
+                             and is not registered with the
+                             L{MMTK.ThreadManager}.
+        @type background: C{bool} or C{str}
         @keyword mpi_communicator: an MPI communicator object, or C{None},
                                    meaning no parallelization (default: C{None})
         @type mpi_communicator: C{Scientific.MPI.MPICommunicator}
         """
-	Minimizer.__init__(self, universe, options)
-	self.features = [Features.FixedParticleFeature,
-			 Features.NoseThermostatFeature,
+        Minimizer.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.NoseThermostatFeature,
                          Features.AndersenBarostatFeature]
 
     def __call__(self, **options):
@@ -124,27 +191,37 @@ class SteepestDescentMinimizer(Minimizer):
         Run the minimizer. The keyword options are the same as described
         under L{__init__}.
         """
-	self.setCallOptions(options)
-	Features.checkFeatures(self, self.universe)
-	configuration = self.universe.configuration()
-	fixed = self.universe.getAtomBooleanArray('fixed')
-        nt = self.getOption('threads')
-        comm = self.getOption('mpi_communicator')
-	evaluator = self.universe.energyEvaluator(threads=nt,
+        self.setCallOptions(options)
+        features = Features.checkFeatures(self, self.universe)
+        options = self._currentOptions()
+        configuration = self.universe.configuration()
+        fixed = self._fixedAtoms(features, configuration)
+        nt = options['threads']
+        comm = options['mpi_communicator']
+        evaluator = self.universe.energyEvaluator(threads=nt,
                                                   mpi_communicator=comm)
         evaluator = evaluator.CEvaluator()
-	args = (self.universe,
-                configuration.array, fixed.array, evaluator,
-                self.getOption('steps'), self.getOption('step_size'),
-                self.getOption('convergence'), self.getActions(),
-                'Steepest descent minimization with ' +
-                self.optionString(['convergence', 'step_size', 'steps']))
-        if self.getOption('background'):
+        function, args = self._kernel(options, configuration.array, fixed,
+                                      evaluator, self.getActions(),
+                                      'Steepest descent minimization with ' +
+                                      self.optionString(['convergence',
+                                                         'step_size',
+                                                         'steps']))
+        if options['background']:
             if not threading:
                 raise OSError("background processing not available")
-            return MinimizerThread(self.universe, steepestDescent, args)
+            return MinimizerThread(self.universe, function, args,
+                                   options['background'] == 'detached')
         else:
-            apply(steepestDescent, args)
+            function(*args)
+
+    def _kernel(self, options, configuration, fixed, evaluator,
+                actions, description):
+        return steepestDescent, (self.universe,
+                                 configuration, fixed, evaluator,
+                                 options['steps'], options['step_size'],
+                                 options['convergence'], actions,
+                                 description)
 
 #
 # Conjugate gradient minimizer
@@ -173,6 +250,10 @@ class ConjugateGradientMinimizer(Minimizer):
                           norm of the potential energy gradient
     """
 
+    default_options = Minimizer.default_options.copy()
+    default_options['wolfe_delta'] = 0.1
+    default_options['wolfe_sigma'] = 0.
+
     def __init__(self, universe, **options):
         """
         @param universe: the universe on which the integrator acts
@@ -185,6 +266,117 @@ class ConjugateGradientMinimizer(Minimizer):
         @keyword convergence: the root-mean-square gradient length at which
                               minimization stops (default is 0.01 kJ/mol/nm)
         @type convergence: C{float}
+        @keyword wolfe_sigma: if positive, the line search stops at the
+                              first point at which the magnitude of the
+                              directional derivative has dropped by this
+                              factor and the energy has decreased
+                              sufficiently (see wolfe_delta). A value of
+                              0.9 saves many energy evaluations. The default
+                              of 0 means a nearly exact line search.
+        @type wolfe_sigma: C{float}
+        @keyword wolfe_delta: the sufficient-decrease parameter of the
+                              Wolfe conditions (default is 0.1)
+        @type wolfe_delta: C{float}
+        @keyword actions: a list of actions to be executed periodically
+                          (default is none)
+        @type actions: C{list}
+        @keyword threads: the number of threads to use in energy evaluation
+                          (default set by MMTK_ENERGY_THREADS)
+        @type threads: C{int}
+        @keyword background: if True, the integration is executed as a
+                             separate thread (default: False). With
+                             'detached', the thread is a daemon thread
+                             and is not registered with the
+                             L{MMTK.ThreadManager}.
+        @type background: C{bool} or C{str}
+        """
+        Minimizer.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.NoseThermostatFeature]
+
+    def __call__(self, **options):
+        """
+        Run the minimizer. The keyword options are the same as described
+        under L{__init__}.
+        """
+        self.setCallOptions(options)
+        features = Features.checkFeatures(self, self.universe)
+        options = self._currentOptions()
+        configuration = self.universe.configuration()
+        fixed = self._fixedAtoms(features, configuration)
+        nt = options['threads']
+        evaluator = self.universe.energyEvaluator(threads=nt).CEvaluator()
+        function, args = self._kernel(options, configuration.array, fixed,
+                                      evaluator, self.getActions(),
+                                      'Conjugate gradient minimization with '
+                                      + self.optionString(['convergence',
+                                                           'step_size',
+                                                           'steps']))
+        if options['background']:
+            if not threading:
+                raise OSError("background processing not available")
+            return MinimizerThread(self.universe, function, args,
+                                   options['background'] == 'detached')
+        else:
+            function(*args)
+
+    def _kernel(self, options, configuration, fixed, evaluator,
+                actions, description):
+        return conjugateGradient, (self.universe,
+                                   configuration, fixed, evaluator,
+                                   options['steps'], options['step_size'],
+                                   options['convergence'],
+                                   options['wolfe_delta'],
+                                   options['wolfe_sigma'],
+                                   actions, description)
+
+#
+# Limited-memory BFGS minimizer
+#
+class LBFGSMinimizer(Minimizer):
+
+    """
+    Limited-memory BFGS minimizer
+
+    The minimizer keeps the last few position and gradient differences
+    to build an approximation of the inverse Hessian, and usually needs
+    far fewer energy evaluations than steepest descent. It can handle
+    fixed atoms, but no distance constraints. It is fully thread-safe.
+
+    The minimization is started by calling the minimizer object.
+    All the keyword options can be specified either when
+    creating the minimizer or when calling it.
+
+    The following data categories and variables are available for
+    output:
+
+     - category "configuration": configuration and box size (for
+       periodic universes)
+
+     - category "gradients": energy gradients for each atom
+
+     - category "energy": potential energy and
+                          norm of the potential energy gradient
+    """
+
+    default_options = Minimizer.default_options.copy()
+    default_options['history'] = 3
+
+    def __init__(self, universe, **options):
+        """
+        @param universe: the universe on which the integrator acts
+        @type universe: L{MMTK.Universe}
+        @keyword steps: the number of minimization steps (default is 100)
+        @type steps: C{int}
+        @keyword step_size: the length of the first minimization step
+                            (default is 0.002 nm)
+        @type step_size: C{float}
+        @keyword convergence: the root-mean-square gradient length at which
+                              minimization stops (default is 0.01 kJ/mol/nm)
+        @type convergence: C{float}
+        @keyword history: the number of previous steps used in the
+                          inverse Hessian approximation (default is 3)
+        @type history: C{int}
         @keyword actions: a list of actions to be executed periodically
                           (default is none)
         @type actions: C{list}
@@ -192,33 +384,53 @@ class ConjugateGradientMinimizer(Minimizer):
                           (default set by MMTK_ENERGY_THREADS)
         @type threads: C{int}
         @keyword background: if True, the integration is executed as a
-                             separate thread (default: False)
-        @type background: C{bool}
+                             separate thread (default: False). With
+                             'detached', the thread is a daemon thread
+                             and is not registered with the
+                             L{MMTK.ThreadManager}.
+        @type background: C{bool} or C{str}
+        @keyword mpi_communicator: an MPI communicator object, or C{None},
+                                   meaning no parallelization (default: C{None})
+        @type mpi_communicator: C{Scientific.MPI.MPICommunicator}
         """
-	Minimizer.__init__(self, universe, options)
-	self.features = [Features.FixedParticleFeature,
-			 Features.NoseThermostatFeature]
+        Minimizer.__init__(self, universe, options)
+        self.features = [Features.FixedParticleFeature,
+                         Features.NoseThermostatFeature]
 
     def __call__(self, **options):
         """
         Run the minimizer. The keyword options are the same as described
         under L{__init__}.
         """
-	self.setCallOptions(options)
-	Features.checkFeatures(self, self.universe)
-	configuration = self.universe.configuration()
-	fixed = self.universe.getAtomBooleanArray('fixed')
-        nt = self.getOption('threads')
-	evaluator = self.universe.energyEvaluator(threads=nt).CEvaluator()
-	args =(self.universe,
-               configuration.array, fixed.array, evaluator,
-               self.getOption('steps'), self.getOption('step_size'),
-               self.getOption('convergence'), self.getActions(),
-               'Conjugate gradient minimization with ' +
-               self.optionString(['convergence', 'step_size', 'steps']))
-        if self.getOption('background'):
+        self.setCallOptions(options)
+        features = Features.checkFeatures(self, self.universe)
+        options = self._currentOptions()
+        configuration = self.universe.configuration()
+        fixed = self._fixedAtoms(features, configuration)
+        nt = options['threads']
+        comm = options['mpi_communicator']
+        evaluator = self.universe.energyEvaluator(threads=nt,
+                                                  mpi_communicator=comm)
+        evaluator = evaluator.CEvaluator()
+        function, args = self._kernel(options, configuration.array, fixed,
+                                      evaluator, self.getActions(),
+                                      'L-BFGS minimization with ' +
+                                      self.optionString(['convergence',
+                                                         'step_size',
+                                                         'steps',
+                                                         'history']))
+        if options['background']:
             if not threading:
                 raise OSError("background processing not available")
-            return MinimizerThread(self.universe, conjugateGradient, args)
+            return MinimizerThread(self.universe, function, args,
+                                   options['background'] == 'detached')
         else:
-            apply(conjugateGradient, args)
+            function(*args)
+
+    def _kernel(self, options, configuration, fixed, evaluator,
+                actions, description):
+        return lbfgs, (self.universe,
+                       configuration, fixed, evaluator,
+                       options['steps'], options['step_size'],
+                       options['convergence'], actions,
+                       options['history'], description)
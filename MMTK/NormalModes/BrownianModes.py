@@ -157,8 +157,15 @@ class BrownianModes(Core.NormalModes):
         self._forceConstantMatrix()
         ev = self._diagonalize()
 
+        # Store the modes in the order of increasing inverse relaxation
+        # time, which is what most eigenvalue routines return anyway.
+        sort_index = N.argsort(ev)
+        if N.logical_or.reduce(sort_index != N.arange(len(ev))):
+            ev = N.take(ev, sort_index)
+            self.array = N.take(self.array, sort_index)
         self.inv_relaxation_times = ev
-        self.sort_index = N.argsort(self.inv_relaxation_times)
+        self.sort_index = N.arange(len(ev))
+        self._sorted = True
         self.array.shape = (self.nmodes, self.natoms, 3)
 
         self.cleanup()
@@ -181,13 +188,40 @@ class BrownianModes(Core.NormalModes):
                             self.inv_relaxation_times[index],
                             self.array[index])
 
+    def _modeBlocks(self, first_mode, block_size=256):
+        # Yields the raw mode vectors, as an array of shape
+        # (n, natoms, 3), and the inverse relaxation times of the
+        # modes from first_mode on, in blocks of block_size modes.
+        for first in range(first_mode, self.nmodes, block_size):
+            if getattr(self, '_sorted', False):
+                last = first+block_size
+                yield self.array[first:last], \
+                      self.inv_relaxation_times[first:last]
+            else:
+                index = self.sort_index[first:first+block_size]
+                yield N.take(self.array, index), \
+                      N.take(self.inv_relaxation_times, index)
+
+    def _invRelaxationTimes(self, first_mode):
+        # The sorted inverse relaxation times from first_mode on.
+        if getattr(self, '_sorted', False):
+            return self.inv_relaxation_times[first_mode:]
+        return N.take(self.inv_relaxation_times, self.sort_index[first_mode:])
+
+    def _subsetArrays(self, subset):
+        # The indices of the atoms in subset, and 1/sqrt(friction)
+        # and the positions for these atoms.
+        atoms = N.nonzero(subset.booleanMask().array)
+        inv_sqrt_friction = N.take(1./self.weights[:, 0], atoms)
+        r = N.take(self.universe.configuration().array, atoms)
+        return atoms, inv_sqrt_friction, r
+
     def fluctuations(self, first_mode=6):
-        f = ParticleProperties.ParticleScalar(self.universe)
-        for i in range(first_mode, self.nmodes):
-            mode = self.rawMode(i)
-            f += (mode*mode)/mode.inv_relaxation_time
-        f = Units.k_B*self.temperature*f/self.friction
-        return f
+        f = N.zeros((self.array.shape[1],), N.Float)
+        for modes, irt in self._modeBlocks(first_mode):
+            f += N.dot(1./irt, N.add.reduce(modes*modes, -1))
+        f *= Units.k_B*self.temperature/self.friction.array
+        return ParticleProperties.ParticleScalar(self.universe, f)
 
     def meanSquareDisplacement(self, subset=None, weights=None,
                                time_range = (0., None, None),
@@ -224,16 +258,16 @@ class BrownianModes(Core.NormalModes):
         weights = weights/(total*self.friction)
         first, last, step = (time_range + (None, None))[:3]
         if last is None:
-            last = 3./self.rawMode(first_mode).inv_relaxation_time
+            last = 3./self._invRelaxationTimes(first_mode)[0]
         if step is None:
             step = (last-first)/300.
         time = N.arange(first, last, step)
         msd = N.zeros(time.shape, N.Float)
-        for i in range(first_mode, self.nmodes):
-            mode = self.rawMode(i)
-            rt = mode.inv_relaxation_time
-            d = (weights*(mode*mode)).sumOverParticles()
-            N.add(msd, d*(1.-N.exp(-rt*time))/rt, msd)
+        for modes, irt in self._modeBlocks(first_mode):
+            d = N.dot(N.add.reduce(modes*modes, -1), weights.array)
+            decay = (1.-N.exp(-irt[:, N.NewAxis]*time[N.NewAxis, :])) \
+                    / irt[:, N.NewAxis]
+            N.add(msd, N.dot(d, decay), msd)
         N.multiply(msd, 2.*Units.k_B*self.temperature, msd)
         return InterpolatingFunction((time,), msd)
 
@@ -264,11 +298,9 @@ class BrownianModes(Core.NormalModes):
             subset = self.universe
         if weights is None:
             weights = self.universe.getParticleScalar('b_coherent')
-        mask = subset.booleanMask()
-        weights = N.repeat(weights.array, mask.array)
+        atoms, inv_sqrt_friction, r = self._subsetArrays(subset)
+        weights = N.take(weights.array, atoms)
         weights = weights/N.sqrt(N.add.reduce(weights*weights))
-        friction = N.repeat(self.friction.array, mask.array)
-        r = N.repeat(self.universe.configuration().array, mask.array)
 
         first, last, step = (q_range+(None,))[:3]
         if step is None:
@@ -280,19 +312,27 @@ class BrownianModes(Core.NormalModes):
         sq = 0.
         random_vectors = Random.randomDirections(random_vectors)
         for v in random_vectors:
-            sab = N.zeros((natoms, natoms), N.Float)
-            for i in range(first_mode, self.nmodes):
-                irt = self.rawMode(i).inv_relaxation_time
-                d = N.repeat((self.rawMode(i)*v).array, mask.array) \
-                       / N.sqrt(friction)
-                sab = sab + (d[N.NewAxis,:]-d[:,N.NewAxis])**2/irt
+            # sab[a, b] = sum_i (d_ib-d_ia)**2/irt_i
+            #           = s_a + s_b - 2 sum_i d_ia d_ib/irt_i
+            s = N.zeros((natoms,), N.Float)
+            dd = N.zeros((natoms, natoms), N.Float)
+            for modes, irt in self._modeBlocks(first_mode):
+                d = N.take(N.dot(modes, v.array), atoms, 1) \
+                    * inv_sqrt_friction
+                dw = d/irt[:, N.NewAxis]
+                s += N.add.reduce(d*dw)
+                dd += N.dot(N.transpose(dw), d)
+            sab = s[N.NewAxis, :] + s[:, N.NewAxis] - 2.*dd
             sab = sab[N.NewAxis,:,:]*q[:, N.NewAxis, N.NewAxis]**2
-            phase = N.exp(-1.j*q[:, N.NewAxis]
-                          * N.dot(r, v.array)[N.NewAxis, :]) \
-                    * weights[N.NewAxis, :]
-            temp = N.sum(phase[:, :, N.NewAxis]*N.exp(-0.5*kT*sab), 1)
-            temp = N.sum(N.conjugate(phase)*temp, 1)
-            sq = sq + temp.real
+            # Only the real part of the sum over phase factors
+            # exp(-iq(r_a-r_b)) is needed.
+            qr = q[:, N.NewAxis]*N.dot(r, v.array)[N.NewAxis, :]
+            cos_qr = N.cos(qr)*weights[N.NewAxis, :]
+            sin_qr = N.sin(qr)*weights[N.NewAxis, :]
+            esab = N.exp(-0.5*kT*sab)
+            sq = sq + N.sum(cos_qr*N.sum(cos_qr[:, :, N.NewAxis]*esab, 1)
+                            + sin_qr*N.sum(sin_qr[:, :, N.NewAxis]*esab, 1),
+                            1)
         return InterpolatingFunction((q,), sq/len(random_vectors))
 
     def coherentScatteringFunction(self, q, time_range = (0., None, None),
@@ -329,44 +369,53 @@ class BrownianModes(Core.NormalModes):
             subset = self.universe
         if weights is None:
             weights = self.universe.getParticleScalar('b_coherent')
-        mask = subset.booleanMask()
-        weights = N.repeat(weights.array, mask.array)
+        atoms, inv_sqrt_friction, r = self._subsetArrays(subset)
+        weights = N.take(weights.array, atoms)
         weights = weights/N.sqrt(N.add.reduce(weights*weights))
-        friction = N.repeat(self.friction.array, mask.array)
-        r = N.repeat(self.universe.configuration().array, mask.array)
 
         first, last, step = (time_range + (None, None))[:3]
         if last is None:
-            last = 3./self.rawMode(first_mode).inv_relaxation_time
+            last = 3./self._invRelaxationTimes(first_mode)[0]
         if step is None:
             step = (last-first)/300.
         time = N.arange(first, last, step)
 
         natoms = subset.numberOfAtoms()
         kT = Units.k_B*self.temperature
-        fcoh = N.zeros((len(time),), N.Complex)
+        fcoh = N.zeros((len(time),), N.Float)
+        irt = self._invRelaxationTimes(first_mode)
+        tau = 1./irt
+        ft = N.exp(-irt[:, N.NewAxis]*time[N.NewAxis, :])*tau[:, N.NewAxis]
         random_vectors = Random.randomDirections(random_vectors)
         for v in random_vectors:
-            phase = N.exp(-1.j*q*N.dot(r, v.array))
-            for ai in range(natoms):
-                fbt = N.zeros((natoms, len(time)), N.Float)
-                for i in range(first_mode, self.nmodes):
-                    irt = self.rawMode(i).inv_relaxation_time
-                    d = q * N.repeat((self.rawMode(i)*v).array, mask.array) \
-                        / N.sqrt(friction)
-                    ft = N.exp(-irt*time)/irt
-                    N.add(fbt,
-                          d[ai] * d[:, N.NewAxis] * ft[N.NewAxis, :],
-                          fbt)
-                    N.add(fbt,
-                          (-0.5/irt) * (d[ai]**2 + d[:, N.NewAxis]**2),
-                          fbt)
+            qr = q*N.dot(r, v.array)
+            wcos_qr = weights*N.cos(qr)
+            wsin_qr = weights*N.sin(qr)
+            d = N.concatenate([N.take(N.dot(modes, v.array), atoms, 1)
+                               for modes, irt_block
+                               in self._modeBlocks(first_mode)])
+            d = q*d*inv_sqrt_friction
+            s = N.dot(tau, d*d)
+            # The double sum over atom pairs is done for blocks of
+            # atoms a at a time, keeping the temporary arrays of
+            # shape (n, natoms) to about a million elements.
+            atom_block = max(1, (1 << 20) // (max(len(d), len(time))*natoms))
+            for first in range(0, natoms, atom_block):
+                last = first+atom_block
+                da = d[:, first:last]
+                nb = da.shape[1]
+                dd = da[:, :, N.NewAxis]*d[:, N.NewAxis, :]
+                dd.shape = (len(d), nb*natoms)
+                fbt = N.dot(N.transpose(dd), ft)
+                fbt.shape = (nb, natoms, len(time))
+                fbt = fbt - 0.5*(s[first:last, N.NewAxis, N.NewAxis]
+                                 + s[N.NewAxis, :, N.NewAxis])
+                efbt = N.exp(kT*fbt)
                 N.add(fcoh,
-                      weights[ai]*phase[ai]
-                      * N.dot(weights*N.conjugate(phase),
-                              N.exp(kT*fbt)),
+                      N.dot(wcos_qr[first:last], N.dot(wcos_qr, efbt))
+                      + N.dot(wsin_qr[first:last], N.dot(wsin_qr, efbt)),
                       fcoh)
-        return InterpolatingFunction((time,), fcoh.real/len(random_vectors))
+        return InterpolatingFunction((time,), fcoh/len(random_vectors))
 
     def incoherentScatteringFunction(self, q, time_range = (0., None, None),
                                      subset=None, random_vectors=15,
@@ -397,17 +446,14 @@ class BrownianModes(Core.NormalModes):
         """
         if subset is None:
             subset = self.universe
-        mask = subset.booleanMask()
+        atoms, inv_sqrt_friction, r = self._subsetArrays(subset)
         weights_inc = self.universe.getParticleScalar('b_incoherent')
-        weights_inc = N.repeat(weights_inc.array**2, mask.array)
+        weights_inc = N.take(weights_inc.array**2, atoms)
         weights_inc = weights_inc/N.add.reduce(weights_inc)
-        friction = N.repeat(self.friction.array, mask.array)
-        mass = N.repeat(self.universe.masses().array, mask.array)
-        r = N.repeat(self.universe.configuration().array, mask.array)
 
         first, last, step = (time_range + (None, None))[:3]
         if last is None:
-            last = 3./self.weighedMode(first_mode).inv_relaxation_time
+            last = 3./self._invRelaxationTimes(first_mode)[0]
         if step is None:
             step = (last-first)/300.
         time = N.arange(first, last, step)
@@ -416,25 +462,20 @@ class BrownianModes(Core.NormalModes):
         kT = Units.k_B*self.temperature
         finc = N.zeros((len(time),), N.Float)
         eisf = 0.
+        irt = self._invRelaxationTimes(first_mode)
+        tau = 1./irt
+        ft = (N.exp(-irt[:, N.NewAxis]*time[N.NewAxis, :])-1.) \
+             * tau[:, N.NewAxis]
         random_vectors = Random.randomDirections(random_vectors)
         for v in random_vectors:
-            phase = N.exp(-1.j*q*N.dot(r, v.array))
-            faat = N.zeros((natoms, len(time)), N.Float)
-            eisf_sum = N.zeros((natoms,), N.Float)
-            for i in range(first_mode, self.nmodes):
-                irt = self.rawMode(i).inv_relaxation_time
-                d = q * N.repeat((self.rawMode(i)*v).array, mask.array) \
-                    / N.sqrt(friction)
-                ft = (N.exp(-irt*time)-1.)/irt
-                N.add(faat,
-                      d[:, N.NewAxis]**2 * ft[N.NewAxis, :],
-                      faat)
-                N.add(eisf_sum, -d**2/irt, eisf_sum)
-            N.add(finc,
-                  N.sum(weights_inc[:, N.NewAxis]
-                        * N.exp(kT*faat), 0),
-                  finc)
-            eisf = eisf + N.sum(weights_inc*N.exp(kT*eisf_sum))
+            d = N.concatenate([N.take(N.dot(modes, v.array), atoms, 1)
+                               for modes, irt_block
+                               in self._modeBlocks(first_mode)])
+            d2 = (q*d*inv_sqrt_friction)**2
+            faat = N.dot(N.transpose(d2), ft)
+            eisf_sum = -N.dot(tau, d2)
+            N.add(finc, N.dot(weights_inc, N.exp(kT*faat)), finc)
+            eisf = eisf + N.dot(weights_inc, N.exp(kT*eisf_sum))
         return InterpolatingFunction((time,), finc/len(random_vectors))
 
 
@@ -474,16 +515,26 @@ class BrownianModes(Core.NormalModes):
             step = (last-first)/50.
         q = N.arange(first, last, step)
 
-        f = ParticleProperties.ParticleTensor(self.universe)
-        for i in range(first_mode, self.nmodes):
-            mode = self.rawMode(i)
-            f = f + (1./mode.inv_relaxation_time)*mode.dyadicProduct(mode)
-        f = Units.k_B*self.temperature*f/self.friction
+        f = N.zeros((self.array.shape[1], 3, 3), N.Float)
+        for modes, irt in self._modeBlocks(first_mode):
+            for i in range(3):
+                for j in range(i, 3):
+                    f[:, i, j] += N.dot(1./irt, modes[:, :, i]*modes[:, :, j])
+        for i in range(3):
+            for j in range(i):
+                f[:, i, j] = f[:, j, i]
+        f *= Units.k_B*self.temperature \
+             / self.friction.array[:, N.NewAxis, N.NewAxis]
+        f = ParticleProperties.ParticleTensor(self.universe, f)
 
         eisf = N.zeros(q.shape, N.Float)
         random_vectors = Random.randomDirections(random_vectors)
         for v in random_vectors:
-            for a in subset.atomList():
-                exp = N.exp(-v*(f[a]*v))
-                N.add(eisf, weights[a]*exp**(q*q), eisf)
+            # v*(f[a]*v) for all atoms; atoms outside the subset
+            # have zero weight.
+            proj = N.dot(N.dot(f.array, v.array), v.array)
+            N.add(eisf,
+                  N.dot(weights.array,
+                        N.exp(-proj[:, N.NewAxis]*(q*q)[N.NewAxis, :])),
+                  eisf)
         return InterpolatingFunction((q,), eisf/len(random_vectors))
@@ -406,5 +406,4 @@ class NormalModes(object):
 def _symmetrize(a):
     n = a.shape[0]
     for i in range(n):
-        for j in range(i+1, n):
-            a[j,i] = a[i,j]
+        a[i+1:, i] = a[i, i+1:]
@@ -17,6 +17,9 @@ from Scientific.indexing import index_expression
 from Scientific import N
 import copy
 
+# Types of plain numbers, tested first when multiplying particle properties
+_number_types = (int, long, float)
+
 #
 # Base class for all properties defined for a universe.
 #
@@ -31,7 +34,17 @@ class ParticleProperty(object):
     ParticleProperty objects store properties that are defined per
     particle, such as mass, position, velocity, etc. The value
     corresponding to a particular atom can be retrieved or changed by
-    indexing with the atom object.
+    indexing with the atom object. For L{ParticleScalar} and
+    L{ParticleVector}, indexing with an integer array of atom indices
+    returns an array containing the values for all these atoms.
+
+    The augmented assignments (+=, -=, *=, /=) modify the object in
+    place when adding or subtracting a number or a property of the
+    same kind, and when multiplying or dividing by a number or a
+    L{ParticleScalar}. Other operands produce a new object, as with
+    the binary operators. Note that in-place modification affects
+    every reference to the object, including shared objects such as
+    the one returned by the universe's masses() method.
     """
 
     def __init__(self, universe, data_rank, value_rank):
@@ -86,10 +99,18 @@ class ParticleProperty(object):
         pass
 
     def _arithmetic(self, other, op, allow_scalar=False):
+        # Fast path for the most frequent case: two compatible
+        # properties of the same rank, whose arrays have the same shape.
+        if isParticleProperty(other) \
+               and other.data_rank == self.data_rank \
+               and other.value_rank == self.value_rank \
+               and other.universe is self.universe \
+               and other.version == self.version:
+            return self.return_class(self.universe, op(self.array, other.array))
         a1 = self.array
         return_class, a2 = self._checkCompatibility(other, allow_scalar)
         if type(a2) != N.ArrayType:
-            a2 = N.array([a2])
+            return return_class(self.universe, op(a1, a2))
         if len(a1.shape) != len(a2.shape):
             if len(a1.shape) == 1:
                 a1 = a1[index_expression[...] +
@@ -121,6 +142,49 @@ class ParticleProperty(object):
     def __rdiv__(self, other):
         return self._arithmetic(other, lambda a, b: N.divide(b, a), True)
 
+    def _inplaceArithmetic(self, other, op, value_rank):
+        # Stores the result of op in self.array if other is a plain
+        # number or a compatible property of the given value rank.
+        # Returns False if the operation cannot be done in place
+        # (other operands, or e.g. float results for an integer array),
+        # in which case the caller uses the binary operator.
+        if isinstance(other, _number_types):
+            a2 = other
+        elif isParticleProperty(other) \
+                 and other.data_rank == self.data_rank \
+                 and other.value_rank == value_rank:
+            self._checkCompatibility(other, True)
+            a2 = other.array[index_expression[...] +
+                             (len(self.array.shape)-len(other.array.shape)) *
+                             index_expression[N.NewAxis]]
+        else:
+            return False
+        try:
+            op(self.array, a2, self.array)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def __iadd__(self, other):
+        if self._inplaceArithmetic(other, N.add, self.value_rank):
+            return self
+        return self + other
+
+    def __isub__(self, other):
+        if self._inplaceArithmetic(other, N.subtract, self.value_rank):
+            return self
+        return self - other
+
+    def __imul__(self, other):
+        if self._inplaceArithmetic(other, N.multiply, 0):
+            return self
+        return self*other
+
+    def __idiv__(self, other):
+        if self._inplaceArithmetic(other, N.divide, 0):
+            return self
+        return self/other
+
     def __neg__(self):
         return self.return_class(self.universe, -self.array)
 
@@ -158,7 +222,7 @@ class ParticleScalar(ParticleProperty):
     multiplied with scalars.
     """
 
-    def __init__(self, universe, data_array=None):
+    def __init__(self, universe, data_array=None, datatype=N.Float):
         """
         @param universe: the universe for which the values are defined
         @type universe: L{MMTK.Universe.Universe}
@@ -168,16 +232,20 @@ class ParticleScalar(ParticleProperty):
                            array myst be of shape (N,), where N is the
                            number of particles in the universe.
         @type data_array: C{Scientific.N.array_type}
+        @param datatype: the datatype of the array that is created
+                         if data_array is C{None}
         """
         ParticleProperty.__init__(self, universe, 1, 0)
         if data_array is None:
-            self.array = N.zeros((self.n,), N.Float)
+            self.array = N.zeros((self.n,), datatype)
         else:
             self.array = data_array
             if data_array.shape[0] != self.n:
                 raise ValueError('Data incompatible with universe')
 
     def __getitem__(self, item):
+        if isinstance(item, N.array_type):
+            return N.take(self.array, item)
         if not isinstance(item, int):
             item = item.index
         return self.array[item]
@@ -234,7 +302,7 @@ class ParticleVector(ParticleProperty):
     as vectors in a 3N-dimensional space are implemented as methods.
     """
 
-    def __init__(self, universe, data_array=None):
+    def __init__(self, universe, data_array=None, datatype=N.Float):
         """
         @param universe: the universe for which the values are defined
         @type universe: L{MMTK.Universe.Universe}
@@ -244,16 +312,20 @@ class ParticleVector(ParticleProperty):
                            array myst be of shape (N,3), where N is the
                            number of particles in the universe.
         @type data_array: C{Scientific.N.array_type}
+        @param datatype: the datatype of the array that is created
+                         if data_array is C{None}
         """
         ParticleProperty.__init__(self, universe, 1, 1)
         if data_array is None:
-            self.array = N.zeros((self.n, 3), N.Float)
+            self.array = N.zeros((self.n, 3), datatype)
         else:
             self.array = data_array
             if data_array.shape[0] != self.n:
                 raise ValueError('Data incompatible with universe')
 
     def __getitem__(self, item):
+        if isinstance(item, N.array_type):
+            return N.take(self.array, item)
         if not isinstance(item, int):
             item = item.index
         return Vector(self.array[item])
@@ -264,6 +336,8 @@ class ParticleVector(ParticleProperty):
         self.array[item] = value.array
 
     def __mul__(self, other):
+        if isinstance(other, _number_types):
+            return ParticleVector(self.universe, self.array*other)
         if isParticleProperty(other):
             if self.universe != other.universe:
                 raise ValueError('Variables are for different universes')
@@ -298,7 +372,7 @@ class ParticleVector(ParticleProperty):
         @rtype: L{ParticleScalar}
         """
         return ParticleScalar(self.universe,
-                              N.sqrt(N.add.reduce(self.array**2,
+                              N.sqrt(N.add.reduce(self.array*self.array,
                                                   -1)))
 
     def sumOverParticles(self):
@@ -310,7 +384,8 @@ class ParticleVector(ParticleProperty):
                   vector
         @rtype: C{float}
         """
-        return N.sqrt(N.add.reduce(N.ravel(self.array**2)))
+        a = N.ravel(self.array)
+        return N.sqrt(N.dot(a, a))
     totalNorm = norm
 
     def scaledToNorm(self, norm):
@@ -326,7 +401,7 @@ class ParticleVector(ParticleProperty):
         """
         if self.universe != other.universe:
             raise ValueError('Variables are for different universes')
-        return N.add.reduce(N.ravel(self.array * other.array))
+        return N.dot(N.ravel(self.array), N.ravel(other.array))
 
     def massWeightedNorm(self):
         """
@@ -335,9 +410,8 @@ class ParticleVector(ParticleProperty):
         @rtype: C{float}
         """
         m = self.universe.masses().array
-        return N.sqrt(N.sum(N.ravel(m[:, N.NewAxis] *
-                                    self.array**2))
-                      / N.sum(m))
+        return N.sqrt(N.add.reduce(N.dot(m, self.array*self.array))
+                      / N.add.reduce(m))
 
     def scaledToMassWeightedNorm(self, norm):
         f = norm/self.massWeightedNorm()
@@ -354,8 +428,7 @@ class ParticleVector(ParticleProperty):
         if self.universe != other.universe:
             raise ValueError('Variables are for different universes')
         m = self.universe.masses().array
-        return N.add.reduce(N.ravel(self.array * other.array * \
-                                    m[:, N.NewAxis]))
+        return N.add.reduce(N.dot(m, self.array*other.array))
 
     def dyadicProduct(self, other):
         """
@@ -419,18 +492,20 @@ class Configuration(ParticleVector):
     __deepcopy__ = __copy__
 
     def hasValidPositions(self):
-        return N.logical_and.reduce(N.ravel(N.less(self.array,
-                                                   Utility.undefined_limit)))
+        a = N.ravel(self.array)
+        return len(a) == 0 or N.maximum.reduce(a) < Utility.undefined_limit
 
     def convertToBoxCoordinates(self):
         array = self.universe._realToBoxPointArray(self.array,
                                                    self.cell_parameters)
-        self.array[:] = array
+        if array is not self.array:
+            self.array[:] = array
 
     def convertFromBoxCoordinates(self):
         array = self.universe._boxToRealPointArray(self.array,
                                                    self.cell_parameters)
-        self.array[:] = array
+        if array is not self.array:
+            self.array[:] = array
 
 #
 # One tensor per particle.
@@ -445,7 +520,7 @@ class ParticleTensor(ParticleProperty):
     of these operations result in another ParticleTensor object.
     """
 
-    def __init__(self, universe, data_array=None):
+    def __init__(self, universe, data_array=None, datatype=N.Float):
         """
         @param universe: the universe for which the values are defined
         @type universe: L{MMTK.Universe.Universe}
@@ -455,10 +530,12 @@ class ParticleTensor(ParticleProperty):
                            array myst be of shape (N,3,3), where N is the
                            number of particles in the universe.
         @type data_array: C{Scientific.N.array_type}
+        @param datatype: the datatype of the array that is created
+                         if data_array is C{None}
         """
         ParticleProperty.__init__(self, universe, 1, 2)
         if data_array is None:
-            self.array = N.zeros((self.n, 3, 3), N.Float)
+            self.array = N.zeros((self.n, 3, 3), datatype)
         else:
             self.array = data_array
             if data_array.shape[0] != self.n:
@@ -475,6 +552,8 @@ class ParticleTensor(ParticleProperty):
         self.array[item] = value.array
 
     def __mul__(self, other):
+        if isinstance(other, _number_types):
+            return ParticleTensor(self.universe, self.array*other)
         if isParticleProperty(other):
             if self.universe != other.universe:
                 raise ValueError('Variables are for different universes')
@@ -501,9 +580,10 @@ class ParticleTensor(ParticleProperty):
         return Tensor(N.add.reduce(self.array, 0))
 
     def trace(self):
-        return ParticleScalar(self.universe,
-                              self.array[:, 0, 0] + self.array[:, 1, 1]
-                              + self.array[:, 2, 2])
+        # Elements 0, 4, and 8 of each flattened 3x3 tensor
+        # are the diagonal elements.
+        a = N.reshape(self.array, (self.n, 9))
+        return ParticleScalar(self.universe, N.add.reduce(a[:, ::4], 1))
 
 ParticleTensor.return_class = ParticleTensor
 
@@ -565,10 +645,8 @@ class SymmetricPairTensor(ParticleProperty):
             a = self.array
             n = a.shape[0]
             a.shape = (3*n, 3*n)
-            nn = 3*n
-            for i in range(nn):
-                for j in range(i+1, nn):
-                    a[j,i] = a[i,j]
+            for i in range(3*n):
+                a[i+1:, i] = a[i, i+1:]
             a.shape = (n, 3, n, 3)
             self.symmetrized = True
 
@@ -579,9 +657,10 @@ class SymmetricPairTensor(ParticleProperty):
                 raise ValueError('Variables are for different universes')
             if other.value_rank == 1:
                 n = self.array.shape[0]
-                sa = N.reshape(self.array, (n, 3, 3*n))
+                sa = N.reshape(self.array, (3*n, 3*n))
                 oa = N.reshape(other.array, (3*n, ))
-                return ParticleVector(self.universe, N.dot(sa, oa))
+                return ParticleVector(self.universe,
+                                      N.reshape(N.dot(sa, oa), (n, 3)))
             else:
                 raise TypeError('not yet implemented')
 
@@ -22,20 +22,33 @@ def calphaFrictionConstants(protein, set=2):
     @rtype: L{MMTK.ParticleProperties.ParticleScalar}
     """
     radius = 1.5
-    atoms = protein.atomCollection()
-    f = MMTK.ParticleProperties.ParticleScalar(protein.universe())
-    for chain in protein:
-        for residue in chain:
-            a = residue.peptide.C_alpha
-            m = atoms.selectShell(a.position(), radius).mass()
-            d = 3.*m/(4.*N.pi*radius**3)
-            if set == 1:  # linear fit to initial slope
-                f[a] = 121.2*d-8600
-            elif set == 2:  # exponential fit 400 steps
-                f[a] = 68.2*d-5160
-            elif set == 3:  # exponential fit 200 steps
-                f[a] = 38.2*d-2160
-            elif set == 4:  # expansion fit 50 steps
-                f[a] = 20.4*d-500.
-                
+    # Coefficients (a, b) of the linear relation a*density+b
+    coefficients = {1: (121.2, -8600.),  # linear fit to initial slope
+                    2: (68.2, -5160.),   # exponential fit 400 steps
+                    3: (38.2, -2160.),   # exponential fit 200 steps
+                    4: (20.4, -500.),    # expansion fit 50 steps
+                   }
+    universe = protein.universe()
+    f = MMTK.ParticleProperties.ParticleScalar(universe)
+    if set not in coefficients:
+        return f
+    slope, offset = coefficients[set]
+    # The positions and masses of the protein atoms are collected once,
+    # and the mass within each C-alpha's sphere is obtained from a
+    # single array operation on the distance vectors.
+    conf = universe.configuration().array
+    indices = N.array([a.index for a in protein.atomList()])
+    positions = N.take(conf, indices)
+    masses = N.take(universe.masses().array, indices)
+    calphas = [residue.peptide.C_alpha for chain in protein
+               for residue in chain]
+    m = N.zeros((len(calphas),), N.Float)
+    for i in range(len(calphas)):
+        d = positions - conf[calphas[i].index]
+        if universe.is_periodic:
+            # Minimum-image convention, as in Universe.distance
+            universe._spec.foldCoordinatesIntoBox(d)
+        m[i] = N.dot(N.add.reduce(d*d, 1) <= radius**2, masses)
+    d = 3.*m/(4.*N.pi*radius**3)
+    N.put(f.array, [a.index for a in calphas], slope*d+offset)
     return f
@@ -11,12 +11,14 @@ Solvation of solute molecules
 __docformat__ = 'epytext'
 
 from MMTK import ChemicalObjects, Units, Universe
+from MMTK.ParticleProperties import ParticleVector
 from MMTK.MolecularSurface import surfaceAndVolume
 from MMTK.Minimization import SteepestDescentMinimizer
 from MMTK.Dynamics import VelocityVerletIntegrator, VelocityScaler, \
                           TranslationRemover, RotationRemover
 from MMTK.Trajectory import Trajectory, TrajectoryOutput, SnapshotGenerator, \
                             StandardLogOutput
+from Scientific import N
 import copy
 
 #
@@ -86,24 +88,50 @@ def addSolvent(universe, solvent, density, scale_factor=4.):
     universe.translateBy(-solute.position())
     universe.scaleSize((cell_volume/universe.cellVolume())**(1./3.))
 
-    # Scale up the universe and add solvent molecules at random positions
+    # Scale up the universe and add solvent molecules at random positions.
+    # The solute bounding spheres are tested with one array expression.
+    # All solvent molecules have the same bounding sphere radius, so
+    # they are sorted into cubic cells whose edge is the collision
+    # distance (or larger); a new molecule can then collide only with
+    # molecules in the 27 cells around its own.
     universe.scaleSize(scale_factor)
     universe.scale_factor = scale_factor
+    solute_centers = N.zeros((len(excluded_regions), 3), N.Float)
+    solute_radii = N.zeros((len(excluded_regions),), N.Float)
+    for i in range(len(excluded_regions)):
+	solute_centers[i] = excluded_regions[i].center.array
+	solute_radii[i] = excluded_regions[i].radius
+    # Every solvent molecule is a rigid copy, so its bounding sphere
+    # is obtained from that of the template by a translation.
+    sphere = solvent.boundingSphere()
+    center_offset = (sphere.center - solvent.position()).array
+    min_distance = 2.*sphere.radius
+    solute_limits = (sphere.radius + solute_radii)**2
+    cell_size = max(min_distance, Units.Ang)
+    cells = {}
     for i in range(n_solvent):
-	m = copy.copy(solvent)
-	m.translateTo(universe.randomPoint())
 	while True:
-	    s = m.boundingSphere()
-	    collision = False
-	    for region in excluded_regions:
-		if (s.center-region.center).length() < s.radius+region.radius:
-		    collision = True
+	    point = universe.randomPoint()
+	    center = point.array + center_offset
+	    d = solute_centers - center
+	    if not N.logical_or.reduce(N.add.reduce(d*d, 1) < solute_limits):
+		cell = tuple([int(x) for x in N.floor(center/cell_size)])
+		neighbours = []
+		for dx in (-1, 0, 1):
+		    for dy in (-1, 0, 1):
+			for dz in (-1, 0, 1):
+			    neighbours.extend(cells.get((cell[0]+dx, cell[1]+dy,
+							 cell[2]+dz), []))
+		if not neighbours:
+		    break
+		d = N.array(neighbours) - center
+		if not N.logical_or.reduce(N.add.reduce(d*d, 1)
+					   < min_distance**2):
 		    break
-	    if not collision:
-		break
-	    m.translateTo(universe.randomPoint())
+	m = copy.copy(solvent)
+	m.translateTo(point)
 	universe.addObject(m)
-	excluded_regions.append(s)
+	cells.setdefault(cell, []).append(center)
 
 #
 # Shrink the universe to its final size
@@ -155,6 +183,17 @@ def shrinkUniverse(universe, temperature=300.*Units.K, trajectory=None,
 	minimizer(steps = 40)
     integrator(steps = 200)
 
+    # Prepare the scaling of all object positions at once: the atom
+    # indices grouped by object, and the inverse permutation that
+    # restores the atom order from the grouped order.
+    atom_lists = [object.atomList() for object in universe]
+    counts = N.array([len(atoms) for atoms in atom_lists])
+    first_atoms = N.add.accumulate(counts) - counts
+    atom_index = N.array([a.index for atoms in atom_lists for a in atoms])
+    inverse_index = N.argsort(atom_index)
+    masses = N.take(universe.masses().array, atom_index)
+    object_masses = N.add.reduceat(masses, first_atoms)
+
     # Scale down the system in small steps
     i = 0
     while universe.scale_factor > 1.:
@@ -162,8 +201,12 @@ def shrinkUniverse(universe, temperature=300.*Units.K, trajectory=None,
             snapshot()
         i = i + 1
 	step_factor = max(scale_factor, 1./universe.scale_factor)
-	for object in universe:
-	    object.translateTo(step_factor*object.position())
+	x = N.take(universe.contiguousObjectConfiguration().array, atom_index)
+	cm = N.add.reduceat(masses[:, N.NewAxis]*x, first_atoms) \
+	     / object_masses[:, N.NewAxis]
+	displacement = N.repeat((step_factor-1.)*cm, counts)
+	universe.addToConfiguration(
+	    ParticleVector(universe, N.take(displacement, inverse_index)))
 	universe.scaleSize(step_factor)
 	universe.scale_factor = universe.scale_factor*step_factor
 	for i in range(3):
@@ -761,14 +761,15 @@ class Universe(Collections.GroupOfAtoms, Visualization.Viewable):
                         threads=None, mpi_communicator=None):
         if self._forcefield is None:
             raise ValueError("no force field defined")
+        key = (subset1, subset2, threads, mpi_communicator)
         try:
-            eval = self._evaluator[(subset1, subset2, threads)]
+            eval = self._evaluator[key]
         except KeyError:
             from MMTK.ForceFields import ForceField
             eval = ForceField.EnergyEvaluator(self, self._forcefield,
                                               subset1, subset2,
                                               threads, mpi_communicator)
-            self._evaluator[(subset1, subset2, threads)] = eval
+            self._evaluator[key] = eval
         return eval
 
     def energy(self, subset1 = None, subset2 = None, small_change=False):
@@ -1586,19 +1587,19 @@ class ParallelepipedicPeriodicUniverse(Periodic3DUniverse):
 
     def _realToBoxPointArray(self, array, parameters=None):
         if parameters is None:
-            matrix = N.reshape(self.data[9:18], (1, 3, 3))
+            matrix = N.reshape(self.data[9:18], (3, 3))
         else:
             parameters = N.concatenate([parameters, N.zeros((10,), N.Float)])
             from MMTK_universe import parallelepiped_invert
             parallelepiped_invert(parameters)
-            matrix = N.reshape(parameters[9:18], (1, 3, 3))
-        return N.add.reduce(matrix*array[:, N.NewAxis, :], axis=-1)
+            matrix = N.reshape(parameters[9:18], (3, 3))
+        return N.dot(array, N.transpose(matrix))
 
     def _boxToRealPointArray(self, array, parameters=None):
         if parameters is None:
             parameters = self.data[:9]
-        matrix = N.reshape(parameters, (1, 3, 3))
-        return N.add.reduce(matrix*array[:, N.NewAxis, :], axis=-1)
+        matrix = N.reshape(parameters, (3, 3))
+        return N.dot(array, N.transpose(matrix))
 
     def CdistanceFunction(self):
         from MMTK_universe import parallelepipedic_universe_distance_function
@@ -37,7 +37,7 @@ __docformat__ = 'epytext'
 
 from MMTK import Units, Utility
 from Scientific import N
-import subprocess, sys, tempfile, os
+import subprocess, sys, tempfile, threading, os
 
 #
 # If you want temporary files in a non-standard directory, make
@@ -45,6 +45,17 @@ import subprocess, sys, tempfile, os
 #
 tempdir = None
 
+#
+# Create a new temporary file and return its name. Unlike changing
+# tempfile.tempdir for a call to tempfile.mktemp, this is safe with
+# multiple threads, and the file name cannot be taken by another
+# process before the file is written.
+#
+def _temporaryFilename(suffix=''):
+    fd, filename = tempfile.mkstemp(suffix, dir=tempdir)
+    os.close(fd)
+    return filename
+
 #
 # Get visualization program names
 #
@@ -84,6 +95,20 @@ def defineVRMLiewer(progname, exec_path):
     """
     viewer['vrml'] = (progname.lower(), exec_path)
 
+#
+# An infinite universe providing the distance function for objects
+# that are not part of any universe. It has no contents, so a single
+# instance can be shared.
+#
+_infinite_universe = None
+
+def _infiniteUniverse():
+    global _infinite_universe
+    if _infinite_universe is None:
+        from MMTK import Universe
+        _infinite_universe = Universe.InfiniteUniverse()
+    return _infinite_universe
+
 #
 # Visualization base class. Defines methods for general visualization
 # tasks.
@@ -172,8 +197,7 @@ class Viewable(object):
         try:
             distance_fn = self.universe().distanceVector
         except AttributeError:
-            from MMTK import Universe
-            distance_fn = Universe.InfiniteUniverse().distanceVector
+            distance_fn = _infiniteUniverse().distanceVector
         return self._graphics(conf, distance_fn, model, module, options)
 
     def _atomColor(self, atom, options):
@@ -183,9 +207,15 @@ class Viewable(object):
         color_values = options.get('color_values', None)
         if color_values is None:
             return atom.color
-        else:
+        # Each atom's color is needed for the atom itself and for
+        # each of its bonds, so it is evaluated only once.
+        colors = options.setdefault('_atom_colors', {})
+        try:
+            return colors[atom.index]
+        except KeyError:
             scale = options['color_scale']
-            return scale(color_values[atom])
+            color = colors[atom.index] = scale(color_values[atom])
+            return color
 
 
 #
@@ -199,6 +229,8 @@ def view(object, *parameters):
 # Display an object or a collection of objects using an external
 # viewing program.
 #
+_file_extensions = {'pdb': '.pdb', 'vrml': '.wrl'}
+
 def genericViewConfiguration(object, configuration = None, format = 'pdb',
                              label = None):
     format = format.lower()
@@ -219,18 +251,10 @@ def genericViewConfiguration(object, configuration = None, format = 'pdb',
         if len(viewer) == 0:
             Utility.warning('No PDB or VRML viewer defined.')
             return
-        format = format.lower()
-        viewer_format = format.split('.')[0]
-        if not viewer.has_key(viewer_format):
-            format = viewer.keys()[0]
-            viewer_format = format.split('.')[0]
-    tempfile.tempdir = tempdir
-    filename = tempfile.mktemp()
-    tempfile.tempdir = None
-    if format[:3] == 'pdb':
-        filename = filename + '.pdb'
-    elif format[:4] == 'vrml':
-        filename = filename + '.wrl'
+        if format.split('.')[0] not in viewer:
+            format = next(iter(viewer))
+    viewer_format = format.split('.')[0]
+    filename = _temporaryFilename(_file_extensions.get(viewer_format, ''))
     if sys.platform == 'win32':
         object.writeToFile(filename, configuration, format)
         import win32api
@@ -247,19 +271,28 @@ def genericViewConfiguration(object, configuration = None, format = 'pdb',
                 print sys.exc_value
     else:
         object.writeToFile(filename, configuration, format)
-        if os.fork() == 0:
-            pipe = os.popen(viewer[format][1] + ' ' + filename + \
-                            ' 1> /dev/null 2>&1', 'w')
-            pipe.close()
-            os.unlink(filename)
-            os._exit(0)
+        _runViewer([viewer[viewer_format][1], filename], filename)
+
+#
+# Run a viewer in the background and remove the temporary file
+# once it exits. Unlike a fork of the Python process, this does
+# not duplicate its memory. The argument list is passed to the
+# viewer without going through a shell.
+#
+def _runViewer(command, filename):
+    devnull = open(os.devnull, 'w')
+    process = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+    devnull.close()
+    def cleanup():
+        process.wait()
+        os.unlink(filename)
+    thread = threading.Thread(target=cleanup)
+    thread.setDaemon(True)
+    thread.start()
 
 def viewConfiguration(*args, **kwargs):
     pdbviewer, exec_path = viewer.get('pdb', (None, None))
-    function = {'vmd': viewConfigurationVMD,
-                'xmol': viewConfigurationXMol,
-                'imol': viewConfigurationIMol,
-                None: genericViewConfiguration}[pdbviewer]
+    function = _view_configuration_functions[pdbviewer]
     function(*args, **kwargs)
 
 #
@@ -280,10 +313,7 @@ def viewSequence(object, conf_list, periodic = False, label = None):
     @type label: C{str}
     """
     pdbviewer, exec_path = viewer.get('pdb', (None, None))
-    function = {'vmd': viewSequenceVMD,
-                'xmol': viewSequenceXMol,
-                'imol': viewSequenceIMol,
-                None: None}[pdbviewer]
+    function = _view_sequence_functions[pdbviewer]
     if function is None:
         Utility.warning('No viewer with animation feature defined.')
     else:
@@ -331,6 +361,32 @@ def viewMode(mode, factor=1., subset=None, label=None):
     viewSequence(subset, [conf, conf+factor*mode, conf, conf-factor*mode], 1,
                  label)
 
+#
+# Write a sequence of configurations to a single PDB file,
+# one MODEL record per configuration.
+#
+def _writeMultiModelPDB(object, conf_list, filename):
+    from MMTK import PDB
+    universe = object.universe()
+    file = PDB.PDBOutputFile(filename)
+    for conf in conf_list:
+        if universe is not None:
+            conf = universe.contiguousObjectConfiguration([object], conf)
+        file.nextModel()
+        file.write(object, conf)
+    file.close()
+
+#
+# Write the first configuration of a sequence to a PDB file and
+# the remaining ones to a DCD file, which is much more compact
+# and faster to write. This works only for whole universes.
+#
+def _writePDBAndDCD(universe, conf_list, pdbfile, dcdfile):
+    from MMTK import DCD
+    sequence = DCD.writePDB(universe, conf_list[0], pdbfile)
+    indices = N.array([a.index for a in sequence], N.Int)
+    DCD.writeDCD(conf_list[1:], dcdfile, 1./Units.Ang, indices)
+
 #
 # XMol support
 #    
@@ -338,26 +394,12 @@ def viewMode(mode, factor=1., subset=None, label=None):
 #
 # Animation with XMol.
 #
-viewConfigurationXMol = viewConfiguration
+viewConfigurationXMol = genericViewConfiguration
 
 def viewSequenceXMol(object, conf_list, periodic = 0, label = None):
-    tempfile.tempdir = tempdir
-    file_list = []
-    for conf in conf_list:
-        file = tempfile.mktemp()
-        file_list.append(file)
-        object.writeToFile(file, conf, 'pdb')
-    bigfile = tempfile.mktemp()
-    tempfile.tempdir = None
-    os.system('cat ' + ' '.join(file_list) + ' > ' + bigfile)
-    for file in file_list:
-        os.unlink(file)
-    if os.fork() == 0:
-        pipe = os.popen('xmol -readFormat pdb ' + bigfile + \
-                        ' 1> /dev/null 2>&1', 'w')
-        pipe.close()
-        os.unlink(bigfile)
-        os._exit(0)
+    bigfile = _temporaryFilename()
+    _writeMultiModelPDB(object, conf_list, bigfile)
+    _runViewer(['xmol', '-readFormat', 'pdb', bigfile], bigfile)
 
 
 #
@@ -379,7 +421,7 @@ def isCalpha(object):
         chain_list = []
         for element in object:
             if isProtein(element):
-                chain_list = chain_list + list(element)
+                chain_list.extend(element)
             elif isPeptideChain(element):
                 chain_list.append(element)
             else:
@@ -387,118 +429,111 @@ def isCalpha(object):
     else:
         return False
     for chain in chain_list:
-        try:
-            if chain.model != 'calpha':
-                return False
-        except AttributeError:
+        if getattr(chain, 'model', None) != 'calpha':
             return False
     return True
 
+#
+# Write a list of commands to a VMD script file
+#
+def _writeVMDScript(filename, commands):
+    file = open(filename, 'w')
+    file.write('\n'.join(commands) + '\n')
+    file.close()
+
+#
+# Start VMD on a script. VMD does not need the file descriptors
+# of the Python process, and it is placed in a session of its own
+# so that it survives the end of the Python process. Neither
+# option exists under Windows.
+#
+def _runVMD(script):
+    command = [viewer['pdb'][1], '-nt', '-e', script]
+    if sys.platform == 'win32':
+        subprocess.Popen(command)
+    else:
+        subprocess.Popen(command, close_fds=True, preexec_fn=os.setsid)
+
+# The corners of a box, in units of its basis vectors, and the
+# index pairs of corners that are connected by the twelve edges.
+_box_corners = N.array([[i, j, k] for i in (0, 1)
+                                  for j in (0, 1)
+                                  for k in (0, 1)], N.Float)
+_box_edges = [(c, c | bit) for c in range(8) for bit in (1, 2, 4)
+              if not c & bit]
+
 def viewConfigurationVMD(object, configuration = None, format = 'pdb',
                       label = None):
     from MMTK import Universe
     format = format.lower()
     if format != 'pdb':
         return genericViewConfiguration(object, configuration, format)
-    tempfile.tempdir = tempdir
-    filename = tempfile.mktemp()
+    filename = _temporaryFilename()
     filename_tcl = filename.replace('\\', '\\\\')
-    script = tempfile.mktemp()
+    script = _temporaryFilename()
     script_tcl = script.replace('\\', '\\\\')
-    tempfile.tempdir = None
     object.writeToFile(filename, configuration, format)
-    file = open(script, 'w')
-    file.write('mol load pdb ' + filename_tcl + '\n')
+    commands = ['mol load pdb ' + filename_tcl]
     if isCalpha(object):
-        file.write('mol modstyle 0 all trace\n')
-    file.write('color Name 1 white\n')
-    file.write('color Name 2 white\n')
-    file.write('color Name 3 white\n')
+        commands.append('mol modstyle 0 all trace')
+    commands.extend(['color Name 1 white',
+                     'color Name 2 white',
+                     'color Name 3 white'])
     if Universe.isUniverse(object):
         # add a box around periodic universes
         basis = object.basisVectors()
         if basis is not None:
-            v1, v2, v3 = basis
-            p = -0.5*(v1+v2+v3)
-            for p1, p2 in [(p, p+v1), (p, p+v2), (p+v1, p+v1+v2),
-                           (p+v2, p+v1+v2), (p, p+v3), (p+v1, p+v1+v3),
-                           (p+v2, p+v2+v3), (p+v1+v2, p+v1+v2+v3),
-                           (p+v3, p+v1+v3), (p+v3, p+v2+v3),
-                           (p+v1+v3, p+v1+v2+v3), (p+v2+v3, p+v1+v2+v3)]:
-                file.write('graphics 0 line {%f %f %f} {%f %f %f}\n' %
-                           (tuple(p1/Units.Ang) + tuple(p2/Units.Ang)))
-    file.write('file delete ' + filename_tcl + '\n')
+            basis = N.array([v.array for v in basis])
+            p = -0.5*N.add.reduce(basis)
+            corners = (N.dot(_box_corners, basis) + p)/Units.Ang
+            commands.extend(['graphics 0 line {%f %f %f} {%f %f %f}'
+                             % (tuple(corners[i1]) + tuple(corners[i2]))
+                             for i1, i2 in _box_edges])
+    commands.append('file delete ' + filename_tcl)
     if sys.platform != 'win32':
             # Under Windows, it seems to be impossible to delete
             # the script file while it is still in use. For the moment
             # we just don't delete it at all.
-        file.write('file delete ' + script_tcl + '\n')
-    file.close()
-    subprocess.Popen([viewer['pdb'][1], '-nt', '-e', script])
+        commands.append('file delete ' + script_tcl)
+    _writeVMDScript(script, commands)
+    _runVMD(script)
 
 #
 # Animate sequence
 #
 def viewSequenceVMD(object, conf_list, periodic = 0, label=None):
-    tempfile.tempdir = tempdir
-    script = tempfile.mktemp()
+    script = _temporaryFilename()
     script_tcl = script.replace('\\', '\\\\')
+    pdbfile = _temporaryFilename()
+    pdbfile_tcl = pdbfile.replace('\\', '\\\\')
     np = object.numberOfPoints()
     universe = object.universe()
+    commands = ['mol load pdb ' + pdbfile_tcl]
     if np == universe.numberOfPoints() \
        and len(conf_list) > 2:
-        from MMTK import DCD
-        pdbfile = tempfile.mktemp()
-        pdbfile_tcl = pdbfile.replace('\\', '\\\\')
-        dcdfile = tempfile.mktemp()
+        dcdfile = _temporaryFilename()
         dcdfile_tcl = dcdfile.replace('\\', '\\\\')
-        tempfile.tempdir = None
-        sequence = DCD.writePDB(universe, conf_list[0], pdbfile)
-        indices = map(lambda a: a.index, sequence)
-        DCD.writeDCD(conf_list[1:], dcdfile, 1./Units.Ang, indices)
-        file = open(script, 'w')
-        file.write('mol load pdb ' + pdbfile_tcl + '\n')
+        _writePDBAndDCD(universe, conf_list, pdbfile, dcdfile)
         if isCalpha(object):
-            file.write('mol modstyle 0 all trace\n')
-        file.write('animate read dcd ' + dcdfile_tcl + '\n')
-        if periodic:
-            file.write('animate style loop\n')
-        else:
-            file.write('animate style once\n')
-        file.write('animate forward\n')
-        file.write('file delete ' + pdbfile_tcl + '\n')
-        file.write('file delete ' + dcdfile_tcl + '\n')
-        if sys.platform != 'win32':
-            # Under Windows, it seems to be impossible to delete
-            # the script file while it is still in use. For the moment
-            # we just don't delete it at all.
-            file.write('file delete ' + script_tcl + '\n')
-        file.close()
+            commands.append('mol modstyle 0 all trace')
+        commands.append('animate read dcd ' + dcdfile_tcl)
+        temporary_files = [pdbfile_tcl, dcdfile_tcl]
     else:
-        file_list = []
-        for conf in conf_list:
-            file = tempfile.mktemp()
-            file_list.append(file)
-            object.writeToFile(file, conf, 'pdb')
-        tempfile.tempdir = None
-        file = open(script, 'w')
-        file.write('mol load pdb ' + file_list[0] + '\n')
-        for conf in file_list[1:]:
-            file.write('animate read pdb ' + conf.replace('\\', '\\\\') + '\n')
-        if periodic:
-            file.write('animate style loop\n')
-        else:
-            file.write('animate style once\n')
-        file.write('animate forward\n')
-        for conf in file_list:
-            file.write('file delete ' + conf.replace('\\', '\\\\') + '\n')
-        if sys.platform != 'win32':
-            # Under Windows, it seems to be impossible to delete
-            # the script file while it is still in use. For the moment
-            # we just don't delete it at all.
-            file.write('file delete ' + script_tcl + '\n')
-        file.close()
-    subprocess.Popen([viewer['pdb'][1], '-nt', '-e', script])
+        _writeMultiModelPDB(object, conf_list, pdbfile)
+        temporary_files = [pdbfile_tcl]
+    if periodic:
+        commands.append('animate style loop')
+    else:
+        commands.append('animate style once')
+    commands.append('animate forward')
+    commands.extend(['file delete ' + f for f in temporary_files])
+    if sys.platform != 'win32':
+        # Under Windows, it seems to be impossible to delete
+        # the script file while it is still in use. For the moment
+        # we just don't delete it at all.
+        commands.append('file delete ' + script_tcl)
+    _writeVMDScript(script, commands)
+    _runVMD(script)
 
 #
 # iMol support
@@ -512,23 +547,27 @@ def viewConfigurationIMol(object, configuration = None, format = 'pdb',
     format = format.lower()
     if format != 'pdb':
         return genericViewConfiguration(object, configuration, format)
-    tempfile.tempdir = tempdir
-    filename = tempfile.mktemp() + '.pdb'
-    tempfile.tempdir = None
+    filename = _temporaryFilename('.pdb')
     object.writeToFile(filename, configuration, format)
-    os.system('open -a %s %s ' % (prog, filename))
+    subprocess.Popen(['open', '-a', viewer['pdb'][0], filename])
 
 #
 # Animate sequence
 #
 def viewSequenceIMol(object, conf_list, periodic = 0, label=None):
-    from MMTK import PDB
-    tempfile.tempdir = tempdir
-    filename = tempfile.mktemp() + '.pdb'
-    file = PDB.PDBOutputFile(filename)
-    for conf in conf_list:
-        file.nextModel()
-        file.write(object, conf)
-    file.close()
-    tempfile.tempdir = None
-    os.system('open -a %s %s ' % (prog, filename))
+    filename = _temporaryFilename('.pdb')
+    _writeMultiModelPDB(object, conf_list, filename)
+    subprocess.Popen(['open', '-a', viewer['pdb'][0], filename])
+
+#
+# Viewer-specific functions, selected by the canonical name of the
+# PDB viewer.
+#
+_view_configuration_functions = {'vmd': viewConfigurationVMD,
+                                 'xmol': viewConfigurationXMol,
+                                 'imol': viewConfigurationIMol,
+                                 None: genericViewConfiguration}
+_view_sequence_functions = {'vmd': viewSequenceVMD,
+                            'xmol': viewSequenceXMol,
+                            'imol': viewSequenceIMol,
+                            None: None}
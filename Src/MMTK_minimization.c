@@ -44,6 +44,72 @@ scale_vectors(vector3 *v, double f, int n)
     *vec++ *= f;
 }
 
+/* The following operations work only on the atoms listed in index.
+   index == NULL means all n atoms, in which case the arrays are
+   treated as flat double arrays. */
+
+static double
+dot_vectors(vector3 *a, vector3 *b, long *index, int n)
+{
+  double sum = 0.;
+  int j;
+  if (index == NULL) {
+    double *pa = (double *)a;
+    double *pb = (double *)b;
+    n *= 3;
+    for (j = 0; j < n; j++)
+      sum += pa[j]*pb[j];
+  }
+  else
+    for (j = 0; j < n; j++) {
+      long k = index[j];
+      sum += a[k][0]*b[k][0] + a[k][1]*b[k][1] + a[k][2]*b[k][2];
+    }
+  return sum;
+}
+
+static void
+axpy_vectors(vector3 *y, double a, vector3 *x, long *index, int n)
+{
+  int j;
+  if (index == NULL) {
+    double *py = (double *)y;
+    double *px = (double *)x;
+    n *= 3;
+    for (j = 0; j < n; j++)
+      py[j] += a*px[j];
+  }
+  else
+    for (j = 0; j < n; j++) {
+      long k = index[j];
+      y[k][0] += a*x[k][0];
+      y[k][1] += a*x[k][1];
+      y[k][2] += a*x[k][2];
+    }
+}
+
+/* Make a list of the atoms that are not fixed. Returns 0 on success,
+   with *index set to NULL if no atom is fixed. */
+
+static int
+moving_atom_list(long *fix, int atoms, int moving_atoms, long **index)
+{
+  int j, k;
+  *index = NULL;
+  if (moving_atoms == atoms)
+    return 0;
+  *index = (long *)malloc((moving_atoms+1)*sizeof(long));
+  if (*index == NULL) {
+    PyErr_SetString(PyExc_MemoryError, "");
+    return -1;
+  }
+  k = 0;
+  for (j = 0; j < atoms; j++)
+    if (!fix[j])
+      (*index)[k++] = j;
+  return 0;
+}
+
 /* Allocate and initialize Output variable descriptors */
 
 static PyTrajectoryVariable *
@@ -105,7 +171,7 @@ steepestDescent(PyObject *dummy, PyObject *args)
   PyFFEvaluatorObject *evaluator;
   PyTrajectoryOutputSpec *output;
   vector3 *x, *f;
-  long *fix;
+  long *fix, *moving = NULL;
   int atoms, moving_atoms;
   int steps;
   double step_size, gradient_convergence;
@@ -166,6 +232,8 @@ steepestDescent(PyObject *dummy, PyObject *args)
     PyErr_SetString(PyExc_MemoryError, "");
     goto error2;
   }
+  if (moving_atom_list(fix, atoms, moving_atoms, &moving) == -1)
+    goto error2;
 
   /* Initialize output */
   output = PyTrajectory_OutputSpecification(universe, spec_list,
@@ -198,11 +266,7 @@ steepestDescent(PyObject *dummy, PyObject *args)
       goto error;
     }
     PyUniverseSpec_StateLock(universe_spec, -1);
-    norm = 0.;
-    for (j = 0; j < atoms; j++)
-      if (!fix[j])
-	norm += f[j][0]*f[j][0] + f[j][1]*f[j][1] + f[j][2]*f[j][2];
-    norm = sqrt(norm/moving_atoms);
+    norm = sqrt(dot_vectors(f, f, moving, moving_atoms)/moving_atoms);
     if (i == 0 || p_energy.energy < min_energy) {
       min_energy = p_energy.energy;
       min_norm = norm;
@@ -228,12 +292,7 @@ steepestDescent(PyObject *dummy, PyObject *args)
       goto error;
     }
     factor = step_size/norm;
-    for (j = 0; j < atoms; j++)
-      if (!fix[j]) {
-	x[j][0] -= factor*f[j][0];
-	x[j][1] -= factor*f[j][1];
-	x[j][2] -= factor*f[j][2];
-      }
+    axpy_vectors(x, -factor, f, moving, moving_atoms);
     universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
   }
 
@@ -259,6 +318,8 @@ steepestDescent(PyObject *dummy, PyObject *args)
   PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
   free(min_configuration);
   free(min_gradients);
+  if (moving != NULL)
+    free(moving);
   Py_DECREF(gradients);
   Py_INCREF(Py_None);
   return Py_None;
@@ -271,6 +332,8 @@ error2:
     free(min_configuration);
   if (min_gradients != NULL)
     free(min_gradients);
+  if (moving != NULL)
+    free(moving);
   Py_DECREF(gradients);
   return NULL;
 }
@@ -289,10 +352,10 @@ conjugateGradient(PyObject *dummy, PyObject *args)
   PyFFEvaluatorObject *evaluator;
   PyTrajectoryOutputSpec *output;
   vector3 *x, *f1, *f2, *h;
-  long *fix;
+  long *fix, *moving = NULL;
   int atoms, moving_atoms;
   int steps;
-  double step_size, gradient_convergence;
+  double step_size, gradient_convergence, delta, sigma;
   char *description;
 
   PyArrayObject *gradients1, *gradients2, *direction;
@@ -300,15 +363,16 @@ conjugateGradient(PyObject *dummy, PyObject *args)
   energy_data p_energy;
   double norm_sq, last_norm_sq, dot, norm;
   double norm_h, line_convergence, sign, step;
-  double last, a, b, ea, eb, da, db;
-  int i, j, reset_count, niter;
+  double last, a, b, ea, eb, da, db, e0, d0;
+  int i, j, reset_count, niter, accepted;
 
   /* Parse and check arguments */
-  if (!PyArg_ParseTuple(args, "OO!O!O!iddO!s", &universe,
+  if (!PyArg_ParseTuple(args, "OO!O!O!iddddO!s", &universe,
 			&PyArray_Type, &configuration,
 			&PyArray_Type, &fixed,
 			&PyFFEvaluator_Type, &evaluator,
 			&steps, &step_size, &gradient_convergence,
+			&delta, &sigma,
 			&PyList_Type, &spec_list, &description))
     return NULL;
   universe_spec = (PyUniverseSpecObject *)
@@ -361,6 +425,8 @@ conjugateGradient(PyObject *dummy, PyObject *args)
   for (j = 0; j < atoms; j++)
     if (fix[j])
       moving_atoms--;
+  if (moving_atom_list(fix, atoms, moving_atoms, &moving) == -1)
+    goto error2;
 
   /* Prepare output data descriptors */
   data_descriptors = get_data_descriptors(configuration, gradients1,
@@ -401,10 +467,7 @@ conjugateGradient(PyObject *dummy, PyObject *args)
   norm_sq = 0.;
   for (i = 0; i < steps; i++) {
     last_norm_sq = norm_sq;
-    norm_sq = 0.;
-    for (j = 0; j < atoms; j++)
-      if (!fix[j])
-	norm_sq += f1[j][0]*f1[j][0] + f1[j][1]*f1[j][1] + f1[j][2]*f1[j][2];
+    norm_sq = dot_vectors(f1, f1, moving, moving_atoms);
     norm = sqrt(norm_sq/moving_atoms);
     if (norm < gradient_convergence)
       break;
@@ -421,14 +484,8 @@ conjugateGradient(PyObject *dummy, PyObject *args)
     if (i == 0)
       copy_vectors(f1, h, atoms);
     else {
-      dot = 0.;
-      for (j = 0; j < atoms; j++)
-	if (!fix[j]) {
-	  dot += f1[j][0]*f2[j][0] + f1[j][1]*f2[j][1] + f1[j][2]*f2[j][2];
-	  f2[j][0] = f1[j][0];
-	  f2[j][1] = f1[j][1];
-	  f2[j][2] = f1[j][2];
-	}
+      dot = dot_vectors(f1, f2, moving, moving_atoms);
+      copy_vectors(f1, f2, atoms);
       if (reset_count == 5*atoms) {
 	for (j = 0; j < atoms; j++) {
 	  h[j][0] = 0.;
@@ -447,14 +504,7 @@ conjugateGradient(PyObject *dummy, PyObject *args)
     /* Line minimization */
 #define eval(p) \
     { \
-      double d = (p)-last; \
-      int j; \
-      for (j = 0; j < atoms; j++) \
-        if (!fix[j]) { \
-	  x[j][0] += sign*d*h[j][0]; \
-	  x[j][1] += sign*d*h[j][1]; \
-	  x[j][2] += sign*d*h[j][2]; \
-        } \
+      axpy_vectors(x, sign*((p)-last), h, moving, moving_atoms); \
       PyUniverseSpec_StateLock(universe_spec, -2); \
       PyUniverseSpec_StateLock(universe_spec, 1); \
       (*evaluator->eval_func)(evaluator, &p_energy, configuration, 0); \
@@ -464,42 +514,42 @@ conjugateGradient(PyObject *dummy, PyObject *args)
         goto error; \
       } \
       PyUniverseSpec_StateLock(universe_spec, -1); \
-      dot = 0.; \
-      for (j = 0; j < atoms; j++) \
-        if (!fix[j]) \
-	  dot += f1[j][0]*h[j][0] + f1[j][1]*h[j][1] + f1[j][2]*h[j][2]; \
-      dot /= (sign*norm_h); \
+      dot = dot_vectors(f1, h, moving, moving_atoms)/(sign*norm_h); \
       last = (p); \
     }
 
-    norm_h = 0.;
-    for (j = 0; j < atoms; j++)
-      if (!fix[j])
-	norm_h += h[j][0]*h[j][0] + h[j][1]*h[j][1] + h[j][2]*h[j][2];
-    norm_h = sqrt(norm_h);
-    dot = 0.;
-    for (j = 0; j < atoms; j++)
-      if (!fix[j])
-	dot += f1[j][0]*h[j][0] + f1[j][1]*h[j][1] + f1[j][2]*h[j][2];
+    norm_h = sqrt(dot_vectors(h, h, moving, moving_atoms));
+    dot = dot_vectors(f1, h, moving, moving_atoms);
     sign = (dot > 0.) ? -1. : 1.;
     dot /= (sign*norm_h);
     step = step_size/norm_h;
     last = 0.;
     a = b = 0.;
-    ea = eb = p_energy.energy;
-    da = db = dot;
+    ea = eb = e0 = p_energy.energy;
+    da = db = d0 = dot;
+    /* With sigma > 0, any point satisfying the Wolfe conditions ends
+       the line search. With sigma == 0, the search continues until
+       the directional derivative is nearly zero. */
+#define wolfe(p) (sigma > 0. && \
+		  p_energy.energy <= e0 + delta*(p)*norm_h*d0 && \
+		  fabs(dot) <= -sigma*d0)
+    accepted = 0;
     niter = 0;
     while (1) {
       a = b; ea = eb; da = db;
       b += step;
       eval(b); eb = p_energy.energy; db = dot;
+      if (wolfe(b)) {
+	accepted = 1;
+	break;
+      }
       if (db > 0)
 	break;
       if (++niter == 100)
 	break;
     }
     niter = 0;
-    while (1) {
+    while (!accepted) {
       double new = ((eb-ea)/norm_h+a*da-b*db)/(da-db);
       if (new < a || new > b)
 	new = 0.5*(a+b);
@@ -510,12 +560,15 @@ conjugateGradient(PyObject *dummy, PyObject *args)
       else {
 	b = new; eb = p_energy.energy; db = dot;
       }
+      if (wolfe(new))
+	break;
       if (db < 0.01*line_convergence)
 	break;
       if (++niter == 100)
 	break;
     }
 #undef eval
+#undef wolfe
     universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
   }
 
@@ -530,8 +583,11 @@ conjugateGradient(PyObject *dummy, PyObject *args)
   PyEval_RestoreThread(evaluator->tstate_save);
 #endif
   PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
+  if (moving != NULL)
+    free(moving);
   Py_DECREF(gradients1);
   Py_DECREF(gradients2);
+  Py_DECREF(direction);
   Py_INCREF(Py_None);
   return Py_None;
 
@@ -539,12 +595,266 @@ conjugateGradient(PyObject *dummy, PyObject *args)
 error:
   PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
 error2:
+  if (moving != NULL)
+    free(moving);
   Py_DECREF(gradients1);
   Py_DECREF(gradients2);
   Py_DECREF(direction);
   return NULL;
 }
 
+/* Limited-memory BFGS minimizer */
+
+static PyObject *
+lbfgs(PyObject *dummy, PyObject *args)
+{
+  PyObject *universe;
+  PyUniverseSpecObject *universe_spec;
+  PyArrayObject *configuration;
+  PyArrayObject *fixed;
+  PyListObject *spec_list;
+  PyFFEvaluatorObject *evaluator;
+  PyTrajectoryOutputSpec *output;
+  vector3 *x, *f, *d, *x_old, *f_old, *s, *y;
+  vector3 *workspace = NULL;
+  double *rho = NULL, *alpha = NULL;
+  long *fix, *moving = NULL;
+  int atoms, moving_atoms;
+  int steps, history;
+  double step_size, gradient_convergence;
+  char *description;
+
+  PyArrayObject *gradients;
+  PyTrajectoryVariable *data_descriptors;
+  energy_data p_energy;
+  double norm, energy_old, dg, t, sy, yy, gamma, beta;
+  int i, j, k, l, npairs, newest, nls;
+
+  /* Parse and check arguments */
+  if (!PyArg_ParseTuple(args, "OO!O!O!iddO!is", &universe,
+			&PyArray_Type, &configuration,
+			&PyArray_Type, &fixed,
+			&PyFFEvaluator_Type, &evaluator,
+			&steps, &step_size, &gradient_convergence,
+			&PyList_Type, &spec_list, &history, &description))
+    return NULL;
+  if (history < 1) {
+    PyErr_SetString(PyExc_ValueError, "history length must be positive");
+    return NULL;
+  }
+  universe_spec = (PyUniverseSpecObject *)
+                   PyObject_GetAttrString(universe, "_spec");
+  if (universe_spec == NULL)
+    return NULL;
+
+  /* Create gradient array */
+#if defined(NUMPY)
+  gradients = (PyArrayObject *)PyArray_Copy(configuration);
+#else
+  gradients = (PyArrayObject *)PyArray_FromDims(configuration->nd,
+						configuration->dimensions,
+						PyArray_DOUBLE);
+#endif
+  if (gradients == NULL)
+    return NULL;
+  /* Set some convenient variables */
+  atoms = configuration->dimensions[0];
+  x = (vector3 *)configuration->data;
+  f = (vector3 *)gradients->data;
+  fix = (long *)fixed->data;
+
+  moving_atoms = atoms;
+  for (j = 0; j < atoms; j++)
+    if (fix[j])
+      moving_atoms--;
+
+  /* Prepare output data descriptors */
+  data_descriptors = get_data_descriptors(configuration, gradients,
+					  &p_energy.energy, &norm,
+					  universe_spec->geometry_data,
+					  universe_spec->geometry_data_length);
+
+  /* Allocate the search direction, the previous point, and the
+     ring buffers for the last history (s, y) pairs in one block */
+  workspace = (vector3 *)malloc((3+2*history)*atoms*sizeof(vector3));
+  rho = (double *)malloc(2*history*sizeof(double));
+  if (workspace == NULL || rho == NULL) {
+    PyErr_SetString(PyExc_MemoryError, "");
+    goto error2;
+  }
+  if (moving_atom_list(fix, atoms, moving_atoms, &moving) == -1)
+    goto error2;
+  alpha = rho + history;
+  d = workspace;
+  x_old = d + atoms;
+  f_old = x_old + atoms;
+  s = f_old + atoms;
+  y = s + history*atoms;
+
+  /* Initialize output */
+  output = PyTrajectory_OutputSpecification(universe, spec_list,
+					    description,
+					    data_descriptors);
+  if (output == NULL)
+    goto error2;
+
+#define eval() \
+    { \
+      PyUniverseSpec_StateLock(universe_spec, -2); \
+      PyUniverseSpec_StateLock(universe_spec, 1); \
+      (*evaluator->eval_func)(evaluator, &p_energy, configuration, 0); \
+      PyUniverseSpec_StateLock(universe_spec, 2); \
+      if (p_energy.error) { \
+	PyEval_RestoreThread(evaluator->tstate_save); \
+        goto error; \
+      } \
+      PyUniverseSpec_StateLock(universe_spec, -1); \
+    }
+
+  /* Get write access for the minimization, switching to
+     read access only during energy evaluation */
+#ifdef WITH_THREAD
+  evaluator->tstate_save = PyEval_SaveThread();
+#endif
+  PyUniverseSpec_StateLock(universe_spec, -1);
+
+  /* Minimization main loop */
+  p_energy.gradients = (PyObject *)gradients;
+  p_energy.gradient_fn = NULL;
+  p_energy.force_constants = NULL;
+  p_energy.fc_fn = NULL;
+  i = 0;
+  eval();
+  npairs = 0;
+  newest = -1;
+  for (i = 0; i < steps; i++) {
+    norm = sqrt(dot_vectors(f, f, moving, moving_atoms)/moving_atoms);
+    if (norm < gradient_convergence)
+      break;
+    if (PyTrajectory_Output(output, i, data_descriptors,
+			    &evaluator->tstate_save) == -1) {
+      PyUniverseSpec_StateLock(universe_spec, -2);
+#ifdef WITH_THREAD
+      PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+      goto error;
+    }
+
+    /* Two-loop recursion: d = -H f */
+    copy_vectors(f, d, atoms);
+    for (k = 0; k < npairs; k++) {
+      l = (newest - k + history) % history;
+      alpha[l] = rho[l]*dot_vectors(s+l*atoms, d, moving, moving_atoms);
+      axpy_vectors(d, -alpha[l], y+l*atoms, moving, moving_atoms);
+    }
+    if (npairs > 0) {
+      yy = dot_vectors(y+newest*atoms, y+newest*atoms, moving, moving_atoms);
+      gamma = 1./(rho[newest]*yy);
+    }
+    else
+      /* First step or restart: a steepest-descent step of length
+	 step_size */
+      gamma = step_size/sqrt(dot_vectors(f, f, moving, moving_atoms));
+    scale_vectors(d, gamma, atoms);
+    for (k = npairs-1; k >= 0; k--) {
+      l = (newest - k + history) % history;
+      beta = rho[l]*dot_vectors(y+l*atoms, d, moving, moving_atoms);
+      axpy_vectors(d, alpha[l]-beta, s+l*atoms, moving, moving_atoms);
+    }
+    scale_vectors(d, -1., atoms);
+    dg = dot_vectors(d, f, moving, moving_atoms);
+    if (dg >= 0.) {
+      /* Not a descent direction: discard the history */
+      copy_vectors(f, d, atoms);
+      scale_vectors(d, -step_size/sqrt(dot_vectors(f, f, moving, moving_atoms)), atoms);
+      dg = dot_vectors(d, f, moving, moving_atoms);
+      npairs = 0;
+    }
+
+    /* Backtracking line search with the Armijo condition */
+    copy_vectors(x, x_old, atoms);
+    copy_vectors(f, f_old, atoms);
+    energy_old = p_energy.energy;
+    t = 1.;
+    for (nls = 0; nls < 30; nls++) {
+      copy_vectors(x_old, x, atoms);
+      axpy_vectors(x, t, d, moving, moving_atoms);
+      eval();
+      if (p_energy.energy <= energy_old + 1.e-4*t*dg)
+	break;
+      t *= 0.5;
+    }
+    if (nls == 30) {
+      /* No decrease found: go back to the last point */
+      copy_vectors(x_old, x, atoms);
+      copy_vectors(f_old, f, atoms);
+      p_energy.energy = energy_old;
+      if (npairs == 0)
+	break;
+      npairs = 0;
+      continue;
+    }
+
+    /* Store the new (s, y) pair, overwriting the oldest one */
+    l = (newest + 1) % history;
+    for (j = 0; j < atoms; j++) {
+      s[l*atoms+j][0] = t*d[j][0];
+      s[l*atoms+j][1] = t*d[j][1];
+      s[l*atoms+j][2] = t*d[j][2];
+      y[l*atoms+j][0] = f[j][0] - f_old[j][0];
+      y[l*atoms+j][1] = f[j][1] - f_old[j][1];
+      y[l*atoms+j][2] = f[j][2] - f_old[j][2];
+    }
+    sy = dot_vectors(s+l*atoms, y+l*atoms, moving, moving_atoms);
+    if (sy > 1.e-10*t*fabs(dg)) {
+      rho[l] = 1./sy;
+      newest = l;
+      if (npairs < history)
+	npairs++;
+    }
+    universe_spec->correction_function(x, atoms, universe_spec->geometry_data);
+  }
+#undef eval
+
+  /* Final output */
+  norm = sqrt(dot_vectors(f, f, moving, moving_atoms)/moving_atoms);
+  if (PyTrajectory_Output(output, i, data_descriptors,
+			  &evaluator->tstate_save) == -1) {
+    PyUniverseSpec_StateLock(universe_spec, -2);
+#ifdef WITH_THREAD
+    PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+    goto error;
+  }
+
+  /* Clean up and return None */
+  PyUniverseSpec_StateLock(universe_spec, -2);
+#ifdef WITH_THREAD
+  PyEval_RestoreThread(evaluator->tstate_save);
+#endif
+  PyTrajectory_OutputFinish(output, i, 0, 1, data_descriptors);
+  free(workspace);
+  free(rho);
+  if (moving != NULL)
+    free(moving);
+  Py_DECREF(gradients);
+  Py_INCREF(Py_None);
+  return Py_None;
+
+  /* Clean up and return error */
+error:
+  PyTrajectory_OutputFinish(output, i, 1, 1, data_descriptors);
+error2:
+  if (workspace != NULL)
+    free(workspace);
+  if (rho != NULL)
+    free(rho);
+  if (moving != NULL)
+    free(moving);
+  Py_DECREF(gradients);
+  return NULL;
+}
+
 /*
  * List of functions defined in the module
  */
@@ -552,6 +862,7 @@ error2:
 static PyMethodDef minimization_methods[] = {
   {"steepestDescent", steepestDescent, 1},
   {"conjugateGradient", conjugateGradient, 1},
+  {"lbfgs", lbfgs, 1},
   {NULL, NULL}		/* sentinel */
 };
 
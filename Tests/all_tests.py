@@ -12,6 +12,8 @@ import energy_tests
 import trajectory_tests
 import normal_mode_tests
 import subspace_tests
+import internal_coordinate_tests
+import minimization_tests
 
 def suite():
     test_suite = unittest.TestSuite()
@@ -22,6 +24,8 @@ def suite():
     test_suite.addTests(normal_mode_tests.suite())
     test_suite.addTests(subspace_tests.suite())
     test_suite.addTests(trajectory_tests.suite())
+    test_suite.addTests(internal_coordinate_tests.suite())
+    test_suite.addTests(minimization_tests.suite())
     return test_suite
 
 if __name__ == '__main__':
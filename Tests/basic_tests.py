@@ -6,6 +6,8 @@
 
 import unittest
 import MMTK
+from MMTK import ParticleScalar, ParticleVector
+from Scientific import N
 
 class GroupOfAtomTest(unittest.TestCase):
 
@@ -23,8 +25,75 @@ class GroupOfAtomTest(unittest.TestCase):
                          self.results['numberOfAtoms'])
 
 
+class ParticlePropertyTest(unittest.TestCase):
+
+    """
+    Test the augmented assignments of ParticleProperties
+    """
+
+    def setUp(self):
+        self.universe = MMTK.InfiniteUniverse()
+        self.universe.water = MMTK.Molecule('water')
+        self.s = ParticleScalar(self.universe, N.array([1., 2., 3.]))
+        self.v = ParticleVector(self.universe,
+                                N.array([[1., 2., 3.],
+                                         [4., 5., 6.],
+                                         [7., 8., 9.]]))
+        self.w = ParticleVector(self.universe,
+                                N.array([[0., 1., 0.],
+                                         [2., 0., 1.],
+                                         [1., 1., 1.]]))
+
+    def assertArraysEqual(self, a1, a2):
+        self.assertEqual(a1.shape, a2.shape)
+        self.assert_(N.logical_and.reduce(N.ravel(a1 == a2)))
+
+    def test_inplace(self):
+        v = self.v
+        expected = self.v.array + self.w.array
+        v += self.w
+        self.assert_(v is self.v)
+        self.assertArraysEqual(v.array, expected)
+        expected = 2.*self.v.array
+        v *= 2.
+        self.assert_(v is self.v)
+        self.assertArraysEqual(v.array, expected)
+        expected = self.v.array*self.s.array[:, N.NewAxis]
+        v *= self.s
+        self.assert_(v is self.v)
+        self.assertArraysEqual(v.array, expected)
+        s = self.s
+        expected = self.s.array*self.s.array
+        s *= self.s
+        self.assert_(s is self.s)
+        self.assertArraysEqual(s.array, expected)
+
+    def test_vectorProduct(self):
+        expected = (self.v*self.w).array
+        v = self.v
+        v *= self.w
+        self.assert_(isinstance(v, ParticleScalar))
+        self.assertArraysEqual(v.array, expected)
+        expected = (self.w*MMTK.Vector(1., 2., 3.)).array
+        w = self.w
+        w *= MMTK.Vector(1., 2., 3.)
+        self.assert_(isinstance(w, ParticleScalar))
+        self.assertArraysEqual(w.array, expected)
+        self.assertArraysEqual(self.v.array, N.array([[1., 2., 3.],
+                                                      [4., 5., 6.],
+                                                      [7., 8., 9.]]))
+
+    def test_tensorProduct(self):
+        t = self.v.dyadicProduct(self.w)
+        self.assertRaises(TypeError, t.__imul__, t)
+
+
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(GroupOfAtomTest)
+    loader = unittest.TestLoader()
+    s = unittest.TestSuite()
+    s.addTest(loader.loadTestsFromTestCase(GroupOfAtomTest))
+    s.addTest(loader.loadTestsFromTestCase(ParticlePropertyTest))
+    return s
 
 if __name__ == '__main__':
     unittest.main()
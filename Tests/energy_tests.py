@@ -8,6 +8,8 @@ import unittest
 from MMTK import *
 from MMTK.MoleculeFactory import MoleculeFactory
 from MMTK.ForceFields import Amber99ForceField
+from MMTK.ForceFields.Restraints import HarmonicDistanceRestraint, \
+                                       HarmonicDistanceRestraintList
 from MMTK_forcefield import NonbondedList
 from MMTK.Random import randomPointInBox
 from MMTK.Utility import pairs
@@ -211,6 +213,36 @@ class ParallelepipedicUniverseNonbondedListTest(unittest.TestCase,
             p = self.universe.boxToRealCoordinates(randomPointInBox(1.))
             self.universe.addObject(Atom('C', position = p))
 
+class RestraintListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = InfiniteUniverse()
+        for i in range(10):
+            p = randomPointInBox(1.)
+            self.universe.addObject(Atom('C', position = p))
+
+    def test_distanceRestraintList(self):
+        atoms = self.universe.atomList()
+        atom_pairs = list(pairs(atoms))[::3]
+        distances = [0.1*(i%5+1) for i in range(len(atom_pairs))]
+        force_constants = [10.*(i%3+1) for i in range(len(atom_pairs))]
+        ff = None
+        for (a1, a2), d, k in zip(atom_pairs, distances, force_constants):
+            r = HarmonicDistanceRestraint(a1, a2, d, k)
+            if ff is None:
+                ff = r
+            else:
+                ff = ff + r
+        self.universe.setForceField(ff)
+        e1, g1 = self.universe.energyAndGradients()
+        self.universe.setForceField(
+            HarmonicDistanceRestraintList(atom_pairs, distances,
+                                          force_constants))
+        e2, g2 = self.universe.energyAndGradients()
+        self.assertAlmostEqual(e1, e2, 10)
+        self.assertTrue(N.maximum.reduce(N.fabs(N.ravel(g1.array-g2.array)))
+                        < 1.e-10)
+
 
 def suite():
     loader = unittest.TestLoader()
@@ -219,6 +251,7 @@ def suite():
     s.addTest(loader.loadTestsFromTestCase(InfiniteUniverseNonbondedListTest))
     s.addTest(loader.loadTestsFromTestCase(OrthorhombicUniverseNonbondedListTest))
     s.addTest(loader.loadTestsFromTestCase(ParallelepipedicUniverseNonbondedListTest))
+    s.addTest(loader.loadTestsFromTestCase(RestraintListTest))
     return s
 
 
@@ -0,0 +1,129 @@
+# Internal coordinate tests
+#
+# Written by Konrad Hinsen
+#
+
+import unittest
+import MMTK
+from MMTK import Units
+from MMTK.Proteins import Protein
+from MMTK.InternalCoordinates import BondLength, BondAngle, DihedralAngle
+from Scientific import N
+
+class PeptideTest(unittest.TestCase):
+
+    """
+    Test InternalCoordinates.BondLength, InternalCoordinates.BondAngle,
+    and InternalCoordinates.DihedralAngle
+    """
+
+    def setUp(self):
+        self.universe = MMTK.InfiniteUniverse()
+        self.universe.peptide = Protein('bala1')
+        self.ace = self.universe.peptide[0][0]
+        self.ala = self.universe.peptide[0][1]
+
+    def _fragmentDistances(self, coordinate):
+        distances = []
+        for fragment in [coordinate.fragment1, coordinate.fragment2]:
+            atoms = fragment.atomList()
+            for i in range(len(atoms)):
+                for j in range(i+1, len(atoms)):
+                    distances.append(self.universe.distance(atoms[i],
+                                                            atoms[j]))
+        return distances
+
+    def _checkSetValue(self, coordinate, value):
+        # The coordinate must take the new value, and each fragment
+        # must move as a rigid body.
+        before = self._fragmentDistances(coordinate)
+        coordinate.setValue(value)
+        new_value = coordinate.getValue()
+        self.assertAlmostEqual(N.cos(new_value), N.cos(value), 8)
+        self.assertAlmostEqual(N.sin(new_value), N.sin(value), 8)
+        after = self._fragmentDistances(coordinate)
+        for d1, d2 in zip(before, after):
+            self.assertAlmostEqual(d1, d2, 10)
+
+    def test_bondLength(self):
+        coordinate = BondLength(self.ala.peptide.C_alpha, self.ala.peptide.C)
+        self._checkSetValue(coordinate, 0.16)
+
+    def test_bondAngle(self):
+        coordinate = BondAngle(self.ala.peptide.N, self.ala.peptide.C_alpha,
+                               self.ala.peptide.C)
+        self._checkSetValue(coordinate, 100.*Units.deg)
+
+    def test_bondAngleZero(self):
+        # For parallel bonds the rotation axis is undefined.
+        n = self.ala.peptide.N
+        ca = self.ala.peptide.C_alpha
+        c = self.ala.peptide.C
+        c.setPosition(ca.position() + 0.5*(n.position()-ca.position()))
+        coordinate = BondAngle(n, ca, c)
+        conf = N.array(self.universe.configuration().array)
+        self.assertRaises(ValueError, coordinate.setValue, 100.*Units.deg)
+        self.assert_(N.logical_and.reduce(
+            N.ravel(self.universe.configuration().array == conf)))
+
+    def test_dihedralAngle(self):
+        coordinate = DihedralAngle(self.ace.CBond, self.ala.peptide.N,
+                                   self.ala.peptide.C_alpha,
+                                   self.ala.peptide.C)
+        self._checkSetValue(coordinate, -60.*Units.deg)
+
+    def test_universeChange(self):
+        # Changing the universe contents replaces the configuration
+        # array that the atom indices refer to.
+        angle = BondAngle(self.ala.peptide.N, self.ala.peptide.C_alpha,
+                          self.ala.peptide.C)
+        dihedral = DihedralAngle(self.ace.CBond, self.ala.peptide.N,
+                                 self.ala.peptide.C_alpha,
+                                 self.ala.peptide.C)
+        self._checkSetValue(angle, 105.*Units.deg)
+        self._checkSetValue(dihedral, -70.*Units.deg)
+        self.universe.water = MMTK.Molecule('water')
+        self._checkSetValue(angle, 95.*Units.deg)
+        self._checkSetValue(dihedral, 60.*Units.deg)
+        del self.universe.water
+        self._checkSetValue(angle, 115.*Units.deg)
+        self._checkSetValue(dihedral, 150.*Units.deg)
+
+    def _referenceMoment(self, fragment, pivot, axis):
+        moment = 0.
+        for atom in fragment.atomList():
+            r = atom.position()-pivot
+            moment = moment + atom.mass()*(r*r-(r*axis)**2)
+        return moment
+
+    def test_axisMomentOfInertia(self):
+        # The pivot is far from both fragments, so the parallel-axis
+        # term makes up most of the moment of inertia. The peptide in
+        # the universe is handled on the configuration array, the
+        # free one through centerAndMomentOfInertia.
+        pivot = MMTK.Vector(1., 0.5, -0.3)
+        axis = MMTK.Vector(1., 2., 2.).normal()
+        for peptide in [self.universe.peptide, Protein('bala1')]:
+            coordinate = DihedralAngle(peptide[0][0].CBond,
+                                       peptide[0][1].peptide.N,
+                                       peptide[0][1].peptide.C_alpha,
+                                       peptide[0][1].peptide.C)
+            coordinate._updateIndices()
+            for fragment, indices, masses, m in \
+                    [(coordinate.fragment1, coordinate._idx1,
+                      coordinate._masses1, coordinate._m1),
+                     (coordinate.fragment2, coordinate._idx2,
+                      coordinate._masses2, coordinate._m2)]:
+                moment = coordinate._axisMomentOfInertia(fragment, indices,
+                                                         masses, m,
+                                                         pivot, axis)
+                reference = self._referenceMoment(fragment, pivot, axis)
+                self.assertAlmostEqual(moment/reference, 1., 10)
+
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(PeptideTest)
+
+if __name__ == '__main__':
+    unittest.main()
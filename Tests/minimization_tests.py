@@ -0,0 +1,83 @@
+# Energy minimization tests
+#
+# Written by Konrad Hinsen
+#
+
+import unittest
+from MMTK import *
+from MMTK.ForceFields.Restraints import HarmonicDistanceRestraintList
+from MMTK.Minimization import LBFGSMinimizer, ConjugateGradientMinimizer
+from MMTK.Utility import pairs
+from Scientific import N
+
+class TetrahedronTest(unittest.TestCase):
+
+    """
+    Test the minimizers on four atoms held together by harmonic
+    distance restraints, whose minimum is a regular tetrahedron.
+    The first atom is fixed.
+    """
+
+    def setUp(self):
+        self.universe = InfiniteUniverse()
+        for p in [Vector(0., 0., 0.), Vector(0.2, 0., 0.),
+                  Vector(0., 0.12, 0.), Vector(0.03, 0.05, 0.17)]:
+            self.universe.addObject(Atom('C', position = p))
+        self.atoms = self.universe.atomList()
+        self.atoms[0].fixed = True
+        self.distance = 0.15
+        self.convergence = 1.e-3
+        atom_pairs = list(pairs(self.atoms))
+        self.universe.setForceField(
+            HarmonicDistanceRestraintList(atom_pairs,
+                                          len(atom_pairs)*[self.distance],
+                                          len(atom_pairs)*[1000.]))
+
+    def assertMinimized(self, conf):
+        for a1, a2 in pairs(self.atoms):
+            d = conf[a2] - conf[a1]
+            self.assertAlmostEqual(d.length(), self.distance, 5)
+        self.assertEqual(conf[self.atoms[0]].length(), 0.)
+
+    def assertConverged(self):
+        e, g = self.universe.energyAndGradients()
+        g = N.take(g.array, [a.index for a in self.atoms[1:]])
+        norm = N.sqrt(N.add.reduce(N.ravel(g*g))/len(g))
+        self.assert_(norm < self.convergence)
+        self.assertMinimized(self.universe.configuration())
+
+    def test_lbfgs(self):
+        minimizer = LBFGSMinimizer(self.universe)
+        minimizer(steps = 500, convergence = self.convergence)
+        self.assertConverged()
+
+    def test_conjugateGradientWolfe(self):
+        minimizer = ConjugateGradientMinimizer(self.universe)
+        minimizer(steps = 500, convergence = self.convergence,
+                  wolfe_sigma = 0.9)
+        self.assertConverged()
+
+    def test_minimizeBatch(self):
+        initial = N.array(self.universe.configuration().array)
+        shifted = N.array(initial)
+        for atom, d in zip(self.atoms[1:], [Vector(0.01, -0.02, 0.),
+                                            Vector(0., 0.03, 0.01),
+                                            Vector(-0.02, 0., 0.02)]):
+            shifted[atom.index] += d.array
+        minimizer = LBFGSMinimizer(self.universe)
+        result = minimizer.minimizeBatch(N.array([initial, shifted]),
+                                         steps = 500,
+                                         convergence = self.convergence)
+        self.assertEqual(result.shape, (2, 4, 3))
+        for conf in result:
+            self.assertMinimized(Configuration(self.universe, conf))
+        # The universe itself is not changed.
+        self.assert_(N.logical_and.reduce(
+            N.ravel(self.universe.configuration().array == initial)))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(TetrahedronTest)
+
+if __name__ == '__main__':
+    unittest.main()
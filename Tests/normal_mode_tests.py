@@ -6,10 +6,12 @@
 
 import unittest
 import MMTK
+import MMTK.Random
 from MMTK.Proteins import Protein
 from MMTK.ForceFields import HarmonicForceField
 from MMTK.Subspace import RigidMotionSubspace, PairDistanceSubspace
 from MMTK import NormalModes
+from Scientific import N
 
 class WaterTest(unittest.TestCase):
 
@@ -82,7 +84,8 @@ class WaterTest(unittest.TestCase):
 class PeptideTest(unittest.TestCase):
 
     """
-    Test VibrationalModes with a RigidMotionSubspace
+    Test VibrationalModes with a RigidMotionSubspace,
+    and NormalModes.BrownianModes
     """
 
     def setUp(self):
@@ -204,6 +207,103 @@ class PeptideTest(unittest.TestCase):
         self.assertAlmostEqual(vmodes[16].norm(), 0.0057883026904, 5)
         self.assertAlmostEqual(vmodes[17].norm(), 0.0054875425125, 5)
 
+    def test_brownianModes(self):
+        friction = self.universe.masses()
+        bmodes = NormalModes.BrownianModes(self.universe, friction)
+        f = bmodes.fluctuations()
+        for atom in self.universe.atomList():
+            ref = 0.
+            for i in range(6, len(bmodes)):
+                mode = bmodes.rawMode(i)
+                ref += (mode[atom]*mode[atom])/mode.inv_relaxation_time
+            ref *= MMTK.Units.k_B*bmodes.temperature/friction[atom]
+            self.assertAlmostEqual(f[atom]/ref, 1.)
+
+    def _projections(self, bmodes, v, first_mode=6):
+        # Mode displacements along v divided by sqrt(friction),
+        # and inverse relaxation times, one mode at a time.
+        d = []
+        irt = []
+        for i in range(first_mode, len(bmodes)):
+            mode = bmodes.rawMode(i)
+            d.append((mode*v).array/N.sqrt(bmodes.friction.array))
+            irt.append(mode.inv_relaxation_time)
+        return N.array(d), N.array(irt)
+
+    def assertArraysClose(self, a1, a2):
+        self.assertEqual(a1.shape, a2.shape)
+        error = N.maximum.reduce(N.fabs(a1-a2))
+        self.assert_(error < 1.e-8*N.maximum.reduce(N.fabs(a2)))
+
+    def test_brownianScattering(self):
+        # Compare with straightforward sums over modes and atom pairs.
+        friction = self.universe.masses()
+        bmodes = NormalModes.BrownianModes(self.universe, friction)
+        directions = MMTK.Random.randomDirections(-3)
+        kT = MMTK.Units.k_B*bmodes.temperature
+        r = self.universe.configuration().array
+        natoms = len(r)
+        b_coh = self.universe.getParticleScalar('b_coherent').array
+        b_coh = b_coh/N.sqrt(N.add.reduce(b_coh*b_coh))
+        b_inc = self.universe.getParticleScalar('b_incoherent').array**2
+        b_inc = b_inc/N.add.reduce(b_inc)
+
+        q = N.arange(1., 5., 1.)
+        sq = N.zeros(q.shape, N.Float)
+        for v in directions:
+            d, irt = self._projections(bmodes, v)
+            sab = N.zeros((natoms, natoms), N.Float)
+            for di, irti in zip(d, irt):
+                sab += (di[N.NewAxis, :]-di[:, N.NewAxis])**2/irti
+            for k in range(len(q)):
+                phase = b_coh*N.exp(-1.j*q[k]*N.dot(r, v.array))
+                sq[k] += N.dot(N.conjugate(phase),
+                               N.dot(N.exp(-0.5*kT*q[k]**2*sab), phase)).real
+        result = bmodes.staticStructureFactor((1., 5., 1.),
+                                              random_vectors=-3)
+        self.assertArraysClose(result.values, sq/len(directions))
+
+        q = 2.5
+        last = 3./bmodes.rawMode(6).inv_relaxation_time
+        time_range = (0., last, last/10.)
+        time = N.arange(*time_range)
+        fcoh = N.zeros(time.shape, N.Complex)
+        finc = N.zeros(time.shape, N.Float)
+        for v in directions:
+            d, irt = self._projections(bmodes, v)
+            d = q*d
+            phase = N.exp(-1.j*q*N.dot(r, v.array))
+            for a in range(natoms):
+                fbt = N.zeros((natoms, len(time)), N.Float)
+                for di, irti in zip(d, irt):
+                    fbt += di[a]*di[:, N.NewAxis] \
+                           * (N.exp(-irti*time)/irti)[N.NewAxis, :]
+                    fbt += (-0.5/irti)*(di[a]**2 + di[:, N.NewAxis]**2)
+                fcoh += b_coh[a]*phase[a] \
+                        * N.dot(b_coh*N.conjugate(phase), N.exp(kT*fbt))
+            faat = N.zeros((natoms, len(time)), N.Float)
+            for di, irti in zip(d, irt):
+                faat += di[:, N.NewAxis]**2 \
+                        * ((N.exp(-irti*time)-1.)/irti)[N.NewAxis, :]
+            finc += N.dot(b_inc, N.exp(kT*faat))
+        result = bmodes.coherentScatteringFunction(q, time_range,
+                                                   random_vectors=-3)
+        self.assertArraysClose(result.values, fcoh.real/len(directions))
+        result = bmodes.incoherentScatteringFunction(q, time_range,
+                                                     random_vectors=-3)
+        self.assertArraysClose(result.values, finc/len(directions))
+
+        q = N.arange(0., 5., 1.)
+        eisf = N.zeros(q.shape, N.Float)
+        for v in directions:
+            d, irt = self._projections(bmodes, v)
+            proj = kT*N.dot(1./irt, d*d)
+            eisf += N.dot(b_inc, N.exp(-proj[:, N.NewAxis]
+                                       * (q*q)[N.NewAxis, :]))
+        result = bmodes.EISF((0., 5., 1.), random_vectors=-3)
+        self.assertArraysClose(result.values, eisf/len(directions))
+
+
 
 def suite():
     loader = unittest.TestLoader()